@@ -30,33 +30,109 @@
 #  DEALINGS IN THE SOFTWARE.
 ###############################################################################
 
+from __future__ import print_function
+import os
 import sys
+import glob
+import argparse
+import multiprocessing
 
-infile = sys.argv[1]
-### OPEN THE LED FILE FOR READING ###
-f = open(infile,'rb')
-#led_descriptor = f.read(720)
-#dset_summary = f.read(4096)
-#pos_record = f.read(4680)
-### WE ONLY WANT THE STATE VECTORS SO SEEK TO THE START ###
-f.seek(4956)
-
-### GET THE INFO NEEDED FOR THE STATE VECTORS ###
-num_points = int(f.read(4))
-year = int(f.read(4))
-month = int(f.read(4))
-day = int(f.read(4))
-jday = int(f.read(4))
-sod = float(f.read(22))
-interval = float(f.read(22))
-
-junk = f.read(182)
-
-### WRITE THE NEW LED FILE ###
-outfile = '%d%02d%02d.LED' % (year,month,day)
-print "Writing: %s" % outfile
-with open(outfile,'w') as LED:
-    LED.write('%d %d %d %f %f\n' % (num_points,year,jday,sod,interval))
-    for i in range(28):
-        tmp = f.read(132)
-        LED.write('%d %d %f %.16f %.16f %.16f %.16f %.16f %.16f\n' % (year,jday,sod+interval*i,float(tmp[0:22]),float(tmp[22:44]),float(tmp[44:66]),float(tmp[66:88]),float(tmp[88:110]),float(tmp[110:132])))
+import numpy as np
+
+### THE STATE VECTORS FOLLOW THE LED DESCRIPTOR, DATA SET SUMMARY AND THE START OF THE POSITION RECORD ###
+#led_descriptor = 720 bytes
+#dset_summary = 4096 bytes
+#pos_record = 4680 bytes
+HEADER_OFFSET = 4956
+HEADER_DTYPE = np.dtype([('num_points','S4'),('year','S4'),('month','S4'),('day','S4'),('jday','S4'),
+                         ('sod','S22'),('interval','S22')])
+STATE_OFFSET = HEADER_OFFSET + HEADER_DTYPE.itemsize + 182
+STATE_DTYPE = np.dtype([(c,'S22') for c in ('x','y','z','vx','vy','vz')])
+
+####################################################
+def read_led_header(infile):
+    '''Read the number of state vectors, the date, start time and interval from an ALOS LED'''
+    f = open(infile,'rb')
+    f.seek(HEADER_OFFSET)
+    h = np.frombuffer(f.read(HEADER_DTYPE.itemsize), dtype=HEADER_DTYPE)[0]
+    f.close()
+    return (int(h['num_points']), int(h['year']), int(h['month']), int(h['day']), int(h['jday']),
+            float(h['sod']), float(h['interval']))
+
+def led_outfile(infile, outdir='.', per_scene=False):
+    '''Return the GMTSAR LED name for an ALOS LED: <outdir>/YYYYMMDD.LED
+
+    With per_scene the file goes in a subdirectory named after the scene
+    (LED-ALPSRP123456780-H1.0__A -> ALPSRP123456780-H1.0__A), since frames
+    of one track share their date.
+    '''
+    num_points, year, month, day, jday, sod, interval = read_led_header(infile)
+    if per_scene:
+        scene = os.path.basename(infile)
+        if scene.startswith('LED-'):
+            scene = scene[4:]
+        outdir = os.path.join(outdir, scene)
+    return os.path.join(outdir, '%d%02d%02d.LED' % (year,month,day))
+
+def convert_led(infile, outfile, force=False):
+    '''Write the GMTSAR LED for an ALOS LED, skipped if the output is newer than infile
+
+    All num_points state vector records are decoded from a memory map in one
+    structured array parse.
+    '''
+    num_points, year, month, day, jday, sod, interval = read_led_header(infile)
+    if os.path.dirname(outfile) and not os.path.isdir(os.path.dirname(outfile)):
+        os.makedirs(os.path.dirname(outfile))
+    if not force and os.path.exists(outfile) and os.path.getmtime(outfile) >= os.path.getmtime(infile):
+        return outfile, False
+    records = np.memmap(infile, dtype=STATE_DTYPE, mode='r', offset=STATE_OFFSET, shape=(num_points,))
+    states = np.column_stack([records[c].astype(float) for c in STATE_DTYPE.names])
+    times = sod + interval*np.arange(num_points)
+    table = np.column_stack((np.full(num_points, year), np.full(num_points, jday), times, states))
+    ### WRITE THE NEW LED FILE ###
+    print("Writing: %s" % outfile)
+    with open(outfile,'w') as LED:
+        LED.write('%d %d %d %f %f\n' % (num_points,year,jday,sod,interval))
+        np.savetxt(LED, table, fmt=['%d','%d','%f'] + ['%.16f']*6)
+    return outfile, True
+
+def convert_worker(args):
+    return convert_led(*args)
+
+####################################################
+def parse():
+    '''Command line parser.'''
+    parser = argparse.ArgumentParser(description='Extract the state vectors from ALOS-1 LED files')
+    parser.add_argument('infiles', action='store', type=str, nargs='+', help='LED files or directories of LED-* files')
+    parser.add_argument('-o', action='store', type=str, dest='outdir', default='.', help='Output directory, with several LED files one subdirectory per scene (Default: current directory)')
+    parser.add_argument('-n', action='store', type=int, dest='nproc', default=1, help='Number of processes (Default: 1)')
+    parser.add_argument('-f', action='store_true', default=False, dest='force', help='Convert even if the output is newer than the LED')
+    clos = parser.parse_args()
+    return clos
+
+if __name__ == '__main__':
+    clos = parse()
+    led_files = []
+    for infile in clos.infiles:
+        if os.path.isdir(infile):
+            led_files.extend(sorted(glob.glob(os.path.join(infile, 'LED-*'))))
+        else:
+            led_files.append(infile)
+    outfiles = [led_outfile(infile, clos.outdir, len(led_files) > 1) for infile in led_files]
+    duplicates = sorted(set(f for f in outfiles if outfiles.count(f) > 1))
+    if duplicates:
+        for outfile in duplicates:
+            print("ERROR: %s would be written from %s" % (outfile, ', '.join(i for i, o in zip(led_files, outfiles) if o == outfile)))
+        sys.exit(1)
+    args = [(infile, outfile, clos.force) for infile, outfile in zip(led_files, outfiles)]
+    if clos.nproc > 1:
+        pool = multiprocessing.Pool(clos.nproc)
+        try:
+            results = pool.map(convert_worker, args, chunksize=8)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [convert_worker(a) for a in args]
+    if len(results) > 1:
+        print("Converted %d LED files, %d already up to date" % (sum(r[1] for r in results), sum(not r[1] for r in results)))
@@ -38,12 +38,22 @@ import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 
-baselineFile = open(sys.argv[1])
+import stackindex
+
 lines = []
-'''Read bl_list.txt and put each line into an array'''
-for line in baselineFile.xreadlines():
-    l = str.replace(line,'\n','').strip()
-    lines.append(l)
+if sys.argv[1].endswith('.db'):
+    '''Read the baseline list from the stack index'''
+    '''An optional second argument chooses the SLC subdirectory, e.g. baseline_plot.py stack.db IW1'''
+    index = stackindex.StackIndex(sys.argv[1])
+    for d, bp, bl, slc in zip(*index.read_baseline_list(sys.argv[2] if len(sys.argv) > 2 else None)):
+        lines.append('%s %f %f %s' % (d, bp, bl, slc))
+    index.close()
+else:
+    baselineFile = open(sys.argv[1])
+    '''Read bl_list.txt and put each line into an array'''
+    for line in baselineFile.xreadlines():
+        l = str.replace(line,'\n','').strip()
+        lines.append(l)
 
 '''This is what we need from bl_list.txt to calculate the pairs'''
 dates   = []
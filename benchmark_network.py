@@ -0,0 +1,71 @@
+#! /usr/bin/env python
+
+###############################################################################
+#  benchmark_network.py
+#
+#  Project:
+#  Purpose:  Time the pair network construction of selectPairsGMTSAR.py
+#  Created:  October 2026
+#
+###############################################################################
+#  Copyright (c) 2026, pygmtsar contributors
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from __future__ import print_function
+import time
+import argparse
+
+import numpy as np
+
+import selectPairsGMTSAR
+
+def synthetic_stack(num_dates, interval=12, sigma=100., seed=0):
+    '''Dates every interval days with normally distributed perpendicular baselines'''
+    rng = np.random.RandomState(seed)
+    tbase = np.arange(num_dates) * interval
+    pbase = rng.normal(0., sigma, num_dates)
+    return pbase, tbase
+
+def parse():
+    '''Command line parser.'''
+    parser = argparse.ArgumentParser(description='Time the pair network construction for synthetic stacks')
+    parser.add_argument('-n', action='store', type=int, nargs='+', dest='sizes', default=[100, 1000, 10000], help='Numbers of dates (Default: 100 1000 10000)')
+    parser.add_argument('-Bcrit', action='store', default=200., dest='Bcrit', help='Critical perpendicular baseline (meters)', type=float)
+    parser.add_argument('-Tcrit', action='store', default=9999, dest='Tcrit', help='Critical temporal baseline (days)', type=int)
+    parser.add_argument('-Dmax', action='store', default=48, dest='lengthDayMax', help='Max. number of days for adding additional pairs', type=int)
+    parser.add_argument('-repeat', action='store', default=3, type=int, help='Number of timed runs per size, the best is reported (Default: 3)')
+    clos = parser.parse_args()
+    return clos
+
+if __name__ == '__main__':
+    clos = parse()
+    print("%8s %8s %8s %12s %12s" % ('dates', 'edges', 'pairs', 'delaunay(s)', 'network(s)'))
+    for num_dates in clos.sizes:
+        pbase, tbase = synthetic_stack(num_dates)
+        t_delaunay = t_network = np.inf
+        for i in range(clos.repeat):
+            start = time.time()
+            edges = selectPairsGMTSAR.delaunay_edges(pbase, tbase)
+            t_delaunay = min(t_delaunay, time.time() - start)
+            start = time.time()
+            pairs, edges, delaunayPairs = selectPairsGMTSAR.build_network(pbase, tbase, clos.Bcrit, clos.Tcrit, clos.lengthDayMax)
+            t_network = min(t_network, time.time() - start)
+        print("%8d %8d %8d %12.4f %12.4f" % (num_dates, len(edges), len(pairs), t_delaunay, t_network))
@@ -34,49 +34,128 @@ from __future__ import print_function
 import os
 import sys
 import glob
-import subprocess as sub
-
-import numpy as np
+import argparse
 
 import gmtsarutils
+import stackindex
+import stagetrace
+import resultcache
 
-masterDate = sys.argv[1]
+def parse():
+    '''Command line parser.'''
+    parser = argparse.ArgumentParser(description='Create the bl_list.txt file with GMTSAR')
+    parser.add_argument('masterDate', action='store', type=str, nargs='?', help='Reference (master) date YYYYMMDD')
+    parser.add_argument('-native', action='store_true', default=False, help='Compute the baselines natively instead of with SAT_baseline (not yet validated, see -check and -verify)')
+    parser.add_argument('-dir', action='store', type=str, dest='slc_dir', help='SLC subdirectory of the swath, e.g. IW1 or IW1_VV (needed when SLC/ holds several)')
+    parser.add_argument('-db', action='store', type=str, dest='db', default=stackindex.DB_NAME, help='Stack index database, relative to the project directory (Default: stack.db)')
+    parser.add_argument('-n', action='store', type=int, dest='nproc', default=4, help='Number of SAT_baseline commands to run at once (Default: 4)')
+    parser.add_argument('-check', action='store_true', default=False, help='Compare the native baselines with SAT_baseline, exit with an error if any differ by more than -tol')
+    parser.add_argument('-tol', action='store', type=float, dest='tolerance', default=gmtsarutils.BASELINE_TOLERANCE, help='Tolerance of -check and -verify in meters (Default: %.1f)' % gmtsarutils.BASELINE_TOLERANCE)
+    parser.add_argument('-record', action='store', type=str, dest='record', help='Record the PRM and LED files and their SAT_baseline outputs in this JSON fixture for -verify')
+    parser.add_argument('-verify', action='store', type=str, dest='verify', help='Check the native baselines against a fixture written by -record and exit (no GMTSAR needed)')
+    parser.add_argument('-cache', action='store', type=str, dest='cache', help='Cache the SAT_baseline results in this directory (see resultcache.py)')
+    parser.add_argument('-trace', action='store', type=str, dest='trace', help='Append the time and resources of each stage and command to this JSON lines file (see stagetrace.py)')
+    clos = parser.parse_args()
+    if not clos.verify and not clos.masterDate:
+        parser.error('the reference date is required')
+    return clos
+
+def print_check(scenes, bperp, bpar, outDicts, failed, tolerance):
+    '''Print the native and SAT_baseline baselines side by side, returns True if they agree within tolerance'''
+    print("%-30s %14s %14s %14s %14s" % ('scene', 'Bperp', 'SAT_Bperp', 'Bpar', 'SAT_Bpar'))
+    for i, (scene, bp, bl, outDict) in enumerate(zip(scenes, bperp, bpar, outDicts)):
+        print("%-30s %14.6f %14.6f %14.6f %14.6f%s" % (scene, bp, float(outDict['B_perpendicular']), bl,
+              float(outDict['B_parallel']), '  DIFFERS' if i in failed else ''))
+    if len(failed):
+        print("ERROR: %d scenes differ from SAT_baseline by more than %.3f m" % (len(failed), tolerance))
+        return False
+    print("All baselines agree with SAT_baseline within %.3f m" % tolerance)
+    return True
+
+def find_project(cwd):
+    '''Return the project directory (the one holding SLC/) and the SLC subdirectory cwd is in, if any'''
+    if os.path.basename(cwd) == 'SLC':
+        return os.path.dirname(cwd), None
+    if os.path.basename(os.path.dirname(cwd)) == 'SLC':
+        return os.path.dirname(os.path.dirname(cwd)), os.path.basename(cwd)
+    return cwd, None
+
+def find_swath_dir(project, slc_dir=None):
+    '''Return the directory with the PRM files of the swath: SLC/<slc_dir>, the only SLC subdirectory, or SLC/ itself'''
+    slc_root = os.path.join(project, 'SLC')
+    if not os.path.isdir(slc_root):
+        return project # PRM files in the project directory
+    if slc_dir:
+        if not os.path.isdir(os.path.join(slc_root, slc_dir)):
+            sys.exit('ERROR: no swath directory %s in %s' % (slc_dir, slc_root))
+        return os.path.join(slc_root, slc_dir)
+    swath_dirs = sorted(set(os.path.basename(os.path.dirname(p)) for p in glob.glob(os.path.join(slc_root, '*', '*.PRM'))))
+    if len(swath_dirs) > 1:
+        sys.exit('ERROR: %s holds the swaths %s, choose one with -dir' % (slc_root, ', '.join(swath_dirs)))
+    if swath_dirs:
+        return os.path.join(slc_root, swath_dirs[0])
+    return slc_root # PRM files directly in SLC/
+
+clos = parse()
+if clos.verify:
+    scenes, bperp, bpar, outDicts, failed = gmtsarutils.check_baseline_fixture(clos.verify, clos.tolerance)
+    sys.exit(0 if print_check(scenes, bperp, bpar, outDicts, failed, clos.tolerance) else 1)
+masterDate = clos.masterDate
+if clos.trace:
+    stagetrace.enable(clos.trace)
+if clos.cache:
+    resultcache.enable(clos.cache)
 
-f = open('bl_list.txt','w')
 workdir = os.getcwd()
+project, cwd_slc_dir = find_project(workdir)
+index = stackindex.StackIndex(os.path.join(project, clos.db))
 
-if os.path.exists('SLC'): 
-    os.chdir('SLC')
-masterPRM = glob.glob("*"+masterDate+'*.PRM')[0]
-prmDict = gmtsarutils.read_prm(masterPRM)
-scID = prmDict['SC_identity']
-prmList = sorted(glob.glob('*PRM'))
+swath_dir = find_swath_dir(project, clos.slc_dir or cwd_slc_dir)
+os.chdir(swath_dir)
+slc_dir = os.path.basename(swath_dir)
+masterPRMs = glob.glob("*"+masterDate+'*.PRM')
+if not masterPRMs:
+    sys.exit('ERROR: no PRM file of %s in %s' % (masterDate, swath_dir))
+masterPRM = masterPRMs[0]
+prms = index.prms('.', '*PRM')
+scID = prms[masterPRM]['SC_identity']
+prmList = sorted(prms)
 for scene in prmList:
-    temp_dict = gmtsarutils.read_prm(scene)
-    if not 'SC_vel' in temp_dict.keys():
+    if not 'SC_vel' in prms[scene]:
        gmtsarutils.calc_dop_orb(scene)
-    date = os.path.splitext(scene)[0]
-    cmd = 'SAT_baseline ' + masterPRM + ' ' + scene
-    pipe = sub.Popen(cmd, shell=True, stdout=sub.PIPE).stdout
-    output = pipe.read()
-    print(output)
-    tmp = output.split('\n')
-    outDict = {}
-    for l in tmp:
-        c = l.split("=")
-        if len(c) < 2:
-            next
-        else:
-            outDict[c[0].strip()] = str.replace(c[1], '\n', '').strip()
-    f.write('%s %5.6f %5.6f %s\n' % (date,float(outDict['B_perpendicular']),float(outDict['B_parallel']),date+'.SLC'))
+outDicts = None
+with stagetrace.Stage('baselines', scenes=len(prmList)):
+    if clos.native:
+        bperp, bpar = index.baselines(masterPRM, prmList)
+    else:
+        outDicts = gmtsarutils.sat_baselines(masterPRM, prmList, clos.nproc)
+        bperp = [float(d['B_perpendicular']) for d in outDicts]
+        bpar = [float(d['B_parallel']) for d in outDicts]
+checked = True
+if clos.check:
+    native_bperp, native_bpar = index.baselines(masterPRM, prmList)
+    if outDicts is None:
+        outDicts = gmtsarutils.sat_baselines(masterPRM, prmList, clos.nproc)
+    failed = gmtsarutils.compare_baselines(native_bperp, native_bpar, outDicts, clos.tolerance)
+    checked = print_check(prmList, native_bperp, native_bpar, outDicts, failed, clos.tolerance)
+if clos.record:
+    gmtsarutils.record_baseline_fixture(os.path.join(workdir, clos.record), masterPRM, prmList, clos.nproc)
+
+dates = [gmtsarutils.prm_date(scene) for scene in prmList]
+slcs = [os.path.splitext(scene)[0]+'.SLC' for scene in prmList]
+f = open('bl_list.txt','w')
+for date, bp, bl, slc in zip(dates, bperp, bpar, slcs):
+    f.write('%s %5.6f %5.6f %s\n' % (date,bp,bl,slc))
 f.close()
-os.chdir(workdir)
+index.write_baseline_list(slc_dir, dates, bperp, bpar, slcs)
+index.close()
 
-### FIND MASTER DATE THAT MINIMIZES BASELINE ###
-dat = open('bl_list.txt','r').readlines()
-data = []
-for d in dat:
-    data.append(d.split())
-dates = np.array([d[0] for d in data])
-pbase = np.array([float(d[1]) for d in data])
-print("OPTIMAL MASTER DATE: %s" %  dates.flat[np.abs(pbase - np.mean(pbase)).argmin()])
+### RANK THE REFERENCE CANDIDATES BY TOTAL NETWORK BASELINE ###
+dates, bperp, bpar, tbase = gmtsarutils.baseline_matrix('bl_list.txt')
+os.chdir(workdir)
+order, score = gmtsarutils.rank_references(bperp, tbase)
+for i, sc in zip(order[:5], score[:5]):
+    print("%s %10.3f" % (dates[i], sc))
+print("OPTIMAL MASTER DATE: %s" % dates[order[0]])
+if not checked:
+    sys.exit(1)
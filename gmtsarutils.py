@@ -1,47 +1,515 @@
-import re
+import os
+import glob
+import json
+import shutil
+import signal
+import tempfile
+import datetime
+import threading
 import subprocess as sub
+from collections import deque
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
-def run_command(cmd):
-    pipe = sub.Popen(cmd, shell=True, stdout=sub.PIPE, stderr=sub.PIPE)
-    stdout, stderr = pipe.communicate()
-    return stdout
+import numpy as np
+
+import stagetrace
+import resultcache
+
+STDERR_TAIL = 20
+
+class CommandError(Exception):
+    '''A command exited with a non-zero code or was killed after its timeout'''
+    def __init__(self, cmd, returncode, stderr='', timeout=None):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stderr = stderr
+        self.timeout = timeout
+        if timeout is not None:
+            msg = '%s: killed after %g s' % (cmd, timeout)
+        else:
+            msg = '%s: exit code %d' % (cmd, returncode)
+        if stderr:
+            msg += '\n' + stderr.rstrip()
+        Exception.__init__(self, msg)
+
+    def __reduce__(self):
+        # so the error can be passed back from a multiprocessing pool worker
+        return (CommandError, (self.cmd, self.returncode, self.stderr, self.timeout))
+
+def _read_lines(pipe, callback, lines):
+    for line in iter(pipe.readline, ''):
+        if callback is not None:
+            callback(line)
+        if lines is not None:
+            lines.append(line)
+    pipe.close()
+
+def _kill_group(proc, timed_out):
+    timed_out.append(True)
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass # already finished
+
+def run_command(cmd, timeout=None, on_stdout=None, on_stderr=None, check=True, capture=True):
+    '''Run a shell command and return its standard output
+
+    stdout and stderr are read line by line while the command runs and each
+    line is passed to on_stdout/on_stderr as it arrives.  With capture=False
+    stdout is not kept and None is returned.  After timeout seconds the
+    command and everything it started are killed.  With check, a non-zero
+    exit or a timeout raises CommandError with the last lines of stderr.
+    '''
+    with stagetrace.Stage(os.path.basename(cmd.split()[0]), cmd=cmd) as stage:
+        proc = sub.Popen(cmd, shell=True, stdout=sub.PIPE, stderr=sub.PIPE, universal_newlines=True,
+                         preexec_fn=os.setsid if timeout else None)
+        out_lines = [] if capture else None
+        err_lines = deque(maxlen=STDERR_TAIL)
+        readers = [threading.Thread(target=_read_lines, args=(proc.stdout, on_stdout, out_lines)),
+                   threading.Thread(target=_read_lines, args=(proc.stderr, on_stderr, err_lines))]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+        timed_out = []
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, _kill_group, (proc, timed_out))
+            timer.start()
+        try:
+            for reader in readers:
+                reader.join()
+            proc.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        stage.info['returncode'] = proc.returncode
+    if check and (timed_out or proc.returncode != 0):
+        raise CommandError(cmd, proc.returncode, ''.join(err_lines), timeout if timed_out else None)
+    if capture:
+        return ''.join(out_lines)
+
+class CommandRunner(object):
+    '''Run shell commands from a pool of threads, at most max_running at once
+
+    runner = CommandRunner(4, timeout=600)
+    for prm_file in prm_files:
+        runner.submit('SAT_baseline %s %s' % (ref_prm_file, prm_file))
+    outputs = runner.wait()
+
+    Keyword arguments are passed on to run_command, or to cached_command if
+    they include inputs (per runner or per command).  wait() returns the outputs in the order the commands were
+    submitted.  If any command failed, wait() raises the error of the first
+    one (a CommandError or whatever else went wrong) once all are finished
+    and runner.errors holds every (index, error).
+    '''
+    def __init__(self, max_running=4, **kwargs):
+        self.max_running = max_running
+        self.kwargs = kwargs
+        self.jobs = queue.Queue()
+        self.workers = []
+        self.results = []
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def submit(self, cmd, **kwargs):
+        options = dict(self.kwargs)
+        options.update(kwargs)
+        self.results.append(None)
+        self.jobs.put((len(self.results) - 1, cmd, options))
+        if len(self.workers) < self.max_running:
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            i, cmd, options = job
+            try:
+                if 'inputs' in options:
+                    self.results[i] = cached_command(cmd, **options)
+                else:
+                    self.results[i] = run_command(cmd, **options)
+            except Exception as e: # also OSError or sqlite errors of the cache, never lose a worker
+                with self.lock:
+                    self.errors.append((i, e))
+
+    def wait(self):
+        for worker in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        if self.errors:
+            self.errors.sort(key=lambda error: error[0])
+            raise self.errors[0][1]
+        return self.results
+
+def cached_command(cmd, inputs, outputs=(), checked=(), **kwargs):
+    '''run_command through the result cache
+
+    When $GMTSAR_CACHE is set (see resultcache.py) the command only runs if
+    it has not run before on the same input files, otherwise its stdout is
+    returned and its output files are copied back from the cache.  checked
+    output files are too large to copy, they must still be in place unchanged.
+    '''
+    cache = resultcache.get_cache()
+    if cache is None:
+        return run_command(cmd, **kwargs)
+    return cache.run(cmd, inputs, outputs, lambda: run_command(cmd, **kwargs), checked)
 
 ####################################################
 def calc_dop_orb(prm_file):
     ##### COMPUTE DOPPLER AND UPDATE PRM FILE #####
     log_file = os.path.splitext(prm_file)[0] + '.log'
-    output = gmtsarutils.run_command('calc_dop_orb ' + prm_file + ' ' + log_file + ' 0 0')
-    log_out = open(log_file).readlines()
-    PRM = open(prm_file, 'a')
-    for line in log_out:
-        PRM.write(line)
-    PRM.close()
+    led_file = os.path.join(os.path.dirname(prm_file), load_prm(prm_file)['led_file'])
+    cached_command('calc_dop_orb ' + prm_file + ' ' + log_file + ' 0 0', [prm_file, led_file], [log_file])
+    params = {}
+    for line in open(log_file):
+        c = line.split("=", 1)
+        if len(c) == 2:
+            params[c[0].strip()] = c[1].strip()
+    ### replace the values, a second run must not add them again ###
+    load_prm(prm_file).update(params)
     os.remove(log_file)
 
+####################################################
+def parse_prm_value(value):
+  '''Convert a PRM value to int or float if possible, otherwise leave it a string'''
+  for typ in (int, float):
+    try:
+      return typ(value)
+    except ValueError:
+      pass
+  return value
+
+class PRM(object):
+  '''A GMTSAR PRM file
+
+  The parameters are available as strings in PRM.strings and as int/float
+  (where they parse) with prm['name'].  update() sets any number of
+  parameters with a single atomic rewrite of the file.  Use load_prm() to get
+  a cached PRM that is only re-read when the file changes.
+  '''
+  def __init__(self, prm_file):
+    self.prm_file = prm_file
+    self.read()
+
+  def read(self):
+    self.stat = os.stat(self.prm_file)
+    self.lines = open(self.prm_file).readlines()
+    self.strings = {}
+    for line in self.lines:
+      c = line.split("=", 1)
+      if len(c) < 2 or line.startswith('%') or line.startswith('#'):
+        continue #ignore commented lines or those without variables
+      self.strings[c[0].strip()] = c[1].strip()
+    self.values = dict((k, parse_prm_value(v)) for k, v in self.strings.items())
+
+  def is_current(self):
+    '''Check whether the file is unchanged since it was read'''
+    try:
+      stat = os.stat(self.prm_file)
+    except OSError:
+      return False
+    return (stat.st_mtime, stat.st_size) == (self.stat.st_mtime, self.stat.st_size)
+
+  def __getitem__(self, param):
+    return self.values[param]
+
+  def __contains__(self, param):
+    return param in self.values
+
+  def get(self, param, default=None):
+    return self.values.get(param, default)
+
+  def keys(self):
+    return self.values.keys()
+
+  def update(self, params):
+    '''Set the parameters in the dict params and write the file once'''
+    lines = []
+    written = set()
+    for line in self.lines:
+      param = line.split("=", 1)[0].strip()
+      if "=" in line and param in params and not line.startswith(('%', '#')):
+        line = '%-23s = %s\n' % (param, params[param])
+        written.add(param)
+      lines.append(line)
+    for param in sorted(set(params) - written):
+      lines.append('%-23s = %s\n' % (param, params[param]))
+    tmp_file = self.prm_file + '.tmp'
+    f = open(tmp_file, 'w')
+    f.writelines(lines)
+    f.close()
+    os.rename(tmp_file, self.prm_file)
+    self.read()
+
+_prm_cache = {}
+
+def load_prm(prm_file):
+  '''Return the PRM for prm_file, re-reading it only if the file changed'''
+  key = os.path.abspath(prm_file)
+  prm = _prm_cache.get(key)
+  if prm is None or not prm.is_current():
+    prm = _prm_cache[key] = PRM(prm_file)
+  return prm
+
+def load_prm_dir(directory='.', pattern='*.PRM'):
+  '''Load every PRM in a directory, returns a dict of base file name -> PRM'''
+  return dict((os.path.basename(prm_file), load_prm(prm_file))
+              for prm_file in sorted(glob.glob(os.path.join(directory, pattern))))
+
 ####################################################
 def read_prm(prm_file):
-  prm_dict = {}
-  for line in open(prm_file):
-    c = line.split("=")
-    if len(c) < 2 or line.startswith('%') or line.startswith('#'): 
-      next #ignore commented lines or those without variables
-    else: 
-      prm_dict[c[0].strip()] = str.replace(c[1], '\n', '').strip()
-  return prm_dict
+  return dict(load_prm(prm_file).strings)
 ####################################################
 def update_prm(file, param, value):
-  output = open(file).readlines()
-  f = open(file, 'w')
-  match = False
-  for line in output:
-    c = line.split("=")
-    l__match = re.match(param, c[0].strip())
-    if l__match:
-      match = True
-      f.write('%-23s = %s\n' % (param, value))
-    else:
-      f.write(line)
-  if not match:
-    f.write('%-23s = %s\n' % (param, value))
-  f.close() 
+  load_prm(file).update({param: value})
+####################################################
+def parse_sat_baseline(output):
+  '''Return the "name = value" lines of SAT_baseline output as a dict of strings'''
+  out_dict = {}
+  for line in output.split('\n'):
+    c = line.split("=", 1)
+    if len(c) == 2:
+      out_dict[c[0].strip()] = c[1].strip()
+  return out_dict
+
+def baseline_inputs(ref_prm_file, prm_file):
+  '''The PRM and LED files SAT_baseline reads'''
+  files = []
+  for p in (ref_prm_file, prm_file):
+    files += [p, os.path.join(os.path.dirname(p), load_prm(p)['led_file'])]
+  return files
+
+def sat_baseline(ref_prm_file, prm_file):
+  '''Run SAT_baseline and return its output as a dict of strings'''
+  return parse_sat_baseline(cached_command('SAT_baseline ' + ref_prm_file + ' ' + prm_file,
+                                           baseline_inputs(ref_prm_file, prm_file)))
+
+def sat_baselines(ref_prm_file, prm_files, max_running=4):
+  '''Run SAT_baseline for each PRM file, max_running at a time, and return the list of output dicts'''
+  runner = CommandRunner(max_running)
+  for prm_file in prm_files:
+    runner.submit('SAT_baseline ' + ref_prm_file + ' ' + prm_file, inputs=baseline_inputs(ref_prm_file, prm_file))
+  return [parse_sat_baseline(output) for output in runner.wait()]
+####################################################
+SPEED_OF_LIGHT = 299792458.
+WGS84_A = 6378137.
+WGS84_E2 = 0.00669437999014
+EPOCH = datetime.date(2000, 1, 1).toordinal()
+
+def clock_seconds(clock):
+  '''Convert a PRM SC_clock (YYYYDDD.fraction of day) to seconds since 2000-01-01'''
+  year = int(clock // 1000)
+  return (datetime.date(year, 1, 1).toordinal() - EPOCH + clock - year * 1000 - 1) * 86400.
+
+def read_led(led_file):
+  '''Read a GMTSAR LED orbit file
+
+  Returns the times (seconds since 2000-01-01) and the (n, 6) position and
+  velocity state vectors.
+  '''
+  data = np.loadtxt(led_file, skiprows=1, ndmin=2)
+  days = np.array([datetime.date(int(y), 1, 1).toordinal() - EPOCH for y in data[:, 0]]) + data[:, 1] - 1
+  return days * 86400. + data[:, 2], data[:, 3:9]
+
+def interpolate_orbits(times, states, t, order=8):
+  '''Lagrange interpolation of several orbits, each at its own time
+
+  times (n, m) and states (n, m, 6) hold n orbits padded with nan, t holds the
+  n times to interpolate at.  Returns the (n, 6) state vectors.
+  '''
+  n = times.shape[0]
+  rows = np.arange(n)[:, None]
+  counts = np.sum(~np.isnan(times), axis=1)
+  order = min(order, counts.min())
+  before = np.sum(times < t[:, None], axis=1)
+  start = np.clip(before - order // 2, 0, counts - order)
+  idx = start[:, None] + np.arange(order)
+  t0 = times[rows[:, 0], start + order // 2]
+  tw = times[rows, idx] - t0[:, None]
+  sw = states[rows, idx]
+  dt = np.repeat((t - t0)[:, None, None] - tw[:, None, :], order, axis=1)
+  denom = tw[:, :, None] - tw[:, None, :]
+  diag = np.eye(order, dtype=bool)[None].repeat(n, axis=0)
+  dt[diag] = 1.
+  denom[diag] = 1.
+  weights = np.prod(dt / denom, axis=2)
+  return np.sum(weights[:, :, None] * sw, axis=1)
+
+def orbit_baselines(ref_prm_file, prm_files):
+  '''Compute B_perpendicular and B_parallel of each scene relative to the reference
+
+  This does the work of running SAT_baseline on every scene in one vectorized
+  pass.  The reference position is interpolated from its LED orbit at the
+  scene center, the closest approach of every repeat orbit is found with a
+  few Newton steps, and the baseline vector is split into the parallel and
+  perpendicular components for the look angle at the center range.
+  Returns the B_perpendicular and B_parallel arrays in the order of prm_files.
+  The split into B_perpendicular and B_parallel is not yet validated against
+  SAT_baseline (see check_baseline_fixture), so the scripts only use it on request.
+  '''
+  ref = load_prm(ref_prm_file)
+  ref_times, ref_states = read_led(os.path.join(os.path.dirname(ref_prm_file), ref['led_file']))
+  t_ref = (clock_seconds(ref['SC_clock_start']) + clock_seconds(ref['SC_clock_stop'])) / 2.
+  S = interpolate_orbits(ref_times[None], ref_states[None], np.array([t_ref]))[0]
+
+  ##### STACK THE REPEAT ORBITS, PADDED WITH NAN #####
+  orbits = [read_led(os.path.join(os.path.dirname(p), load_prm(p)['led_file'])) for p in prm_files]
+  n = len(orbits)
+  m = max(len(o[0]) for o in orbits)
+  times = np.full((n, m), np.nan)
+  states = np.full((n, m, 6), np.nan)
+  for i, (orb_times, orb_states) in enumerate(orbits):
+    times[i, :len(orb_times)] = orb_times
+    states[i, :len(orb_times)] = orb_states
+
+  ##### CLOSEST APPROACH OF EACH REPEAT ORBIT TO THE REFERENCE POSITION #####
+  dist = np.sum((states[:, :, :3] - S[:3]) ** 2, axis=2)
+  dist[np.isnan(dist)] = np.inf
+  t = times[np.arange(n), np.argmin(dist, axis=1)]
+  for it in range(20):
+    R = interpolate_orbits(times, states, t)
+    dt = -np.sum((R[:, :3] - S[:3]) * R[:, 3:], axis=1) / np.sum(R[:, 3:] ** 2, axis=1)
+    t = t + dt
+    if np.max(np.abs(dt)) < 1e-7:
+      break
+  R = interpolate_orbits(times, states, t)
+  B = R[:, :3] - S[:3]
+
+  ##### LOCAL RADIAL / CROSS-TRACK FRAME AT THE REFERENCE #####
+  rs = np.linalg.norm(S[:3])
+  u_r = S[:3] / rs
+  u_a = S[3:] - np.dot(S[3:], u_r) * u_r
+  u_a /= np.linalg.norm(u_a)
+  if str(ref.get('lookdir', 'R')).upper().startswith('L'):
+    u_c = np.cross(u_r, u_a)
+  else:
+    u_c = np.cross(u_a, u_r)
+
+  ##### LOOK ANGLE AT THE CENTER RANGE #####
+  rng = ref['near_range'] + ref['num_rng_bins'] / 2. * SPEED_OF_LIGHT / (2. * ref['rng_samp_rate'])
+  if 'earth_radius' in ref:
+    r_earth = ref['earth_radius']
+  else:
+    sin_lat2 = (S[2] / rs) ** 2
+    r_earth = WGS84_A * np.sqrt((1 - WGS84_E2) ** 2 * sin_lat2 + (1 - sin_lat2)) / np.sqrt(1 - WGS84_E2 * sin_lat2)
+  look = np.arccos((rs ** 2 + rng ** 2 - r_earth ** 2) / (2. * rs * rng))
+
+  Bh = np.dot(B, u_c)
+  Bv = np.dot(B, u_r)
+  bperp = Bh * np.cos(look) + Bv * np.sin(look)
+  bpar = Bh * np.sin(look) - Bv * np.cos(look)
+  return bperp, bpar
+
+BASELINE_TOLERANCE = 0.5 # m, largest accepted difference between orbit_baselines and SAT_baseline
+
+def compare_baselines(bperp, bpar, sat_outputs, tolerance=BASELINE_TOLERANCE):
+  '''Return the indices of the scenes whose baselines differ from the SAT_baseline outputs by more than tolerance (m)'''
+  sat_bperp = np.array([float(d['B_perpendicular']) for d in sat_outputs])
+  sat_bpar = np.array([float(d['B_parallel']) for d in sat_outputs])
+  return np.nonzero((np.abs(bperp - sat_bperp) > tolerance) | (np.abs(bpar - sat_bpar) > tolerance))[0]
+
+def record_baseline_fixture(fixture_file, ref_prm_file, prm_files, max_running=4):
+  '''Record the PRM and LED files of a stack and their SAT_baseline outputs in a JSON fixture
+
+  The fixture is self-contained, so check_baseline_fixture can verify
+  orbit_baselines against it where GMTSAR is not installed.
+  '''
+  files = {}
+  for p in [ref_prm_file] + list(prm_files):
+    for f in (p, os.path.join(os.path.dirname(p), load_prm(p)['led_file'])):
+      files[os.path.basename(f)] = open(f).read()
+  fixture = {'reference': os.path.basename(ref_prm_file),
+             'scenes': [os.path.basename(p) for p in prm_files],
+             'files': files,
+             'sat_baseline': sat_baselines(ref_prm_file, prm_files, max_running)}
+  f = open(fixture_file, 'w')
+  json.dump(fixture, f, indent=1, sort_keys=True)
+  f.close()
+
+def check_baseline_fixture(fixture_file, tolerance=BASELINE_TOLERANCE):
+  '''Run orbit_baselines on a fixture written by record_baseline_fixture
+
+  Returns the scenes, the native Bperp and Bpar, the recorded SAT_baseline
+  outputs and the indices of the scenes off by more than tolerance (m).
+  '''
+  fixture = json.load(open(fixture_file))
+  work_dir = tempfile.mkdtemp(prefix='baselines.')
+  try:
+    for name, text in fixture['files'].items():
+      f = open(os.path.join(work_dir, name), 'w')
+      f.write(text)
+      f.close()
+    bperp, bpar = orbit_baselines(os.path.join(work_dir, fixture['reference']),
+                                  [os.path.join(work_dir, p) for p in fixture['scenes']])
+  finally:
+    shutil.rmtree(work_dir)
+  outputs = fixture['sat_baseline']
+  return fixture['scenes'], bperp, bpar, outputs, compare_baselines(bperp, bpar, outputs, tolerance)
+####################################################
+def prm_date(prm_file):
+  '''Return the YYYYMMDD date of a PRM or SLC name, e.g. IW1_20160519.PRM or 20160519.PRM'''
+  return os.path.splitext(os.path.basename(prm_file))[0].split('_')[-1]
+
+def read_baseline_list(bl_file='bl_list.txt'):
+  '''Read bl_list.txt, returns the dates, Bperp, Bpar and SLC names'''
+  data = [line.split() for line in open(bl_file) if line.strip()]
+  dates = [d[0] for d in data]
+  bperp = np.array([float(d[1]) for d in data])
+  bpar = np.array([float(d[2]) for d in data])
+  slcs = [d[3] for d in data]
+  return dates, bperp, bpar, slcs
+
+def pair_baselines(values):
+  '''All-pairs differences of per-date values: element (i, j) is values[j] - values[i]
+
+  Baselines are additive, so the baselines of every pair follow from the
+  baselines of each date relative to any single reference.
+  '''
+  values = np.asarray(values, dtype=float)
+  return values[None, :] - values[:, None]
+
+def baseline_matrix(bl_file='bl_list.txt'):
+  '''Return the dates and the all-pairs Bperp, Bpar and temporal (days) baseline matrices
+
+  The matrices are cached in bl_matrix.npz next to bl_file and rebuilt when
+  bl_file is newer than the cache.
+  '''
+  cache_file = os.path.join(os.path.dirname(bl_file), 'bl_matrix.npz')
+  if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(bl_file):
+    cache = np.load(cache_file)
+    return [str(d) for d in cache['dates']], cache['bperp'], cache['bpar'], cache['tbase']
+  dates, bperp, bpar, slcs = read_baseline_list(bl_file)
+  days = [datetime.datetime.strptime(d, "%Y%m%d").toordinal() for d in dates]
+  bperp, bpar, tbase = pair_baselines(bperp), pair_baselines(bpar), pair_baselines(days)
+  f = open(cache_file + '.tmp', 'wb')
+  np.savez(f, dates=np.array(dates), bperp=bperp, bpar=bpar, tbase=tbase)
+  f.close()
+  os.rename(cache_file + '.tmp', cache_file)
+  return dates, bperp, bpar, tbase
+
+def rank_references(bperp, tbase, bscale=None, tscale=None):
+  '''Rank reference candidates by their total baseline to every other date
+
+  bperp and tbase are all-pairs matrices (see pair_baselines).  Each pair is
+  scaled by bscale (m) and tscale (days), by default the spread of the stack,
+  and a candidate scores the summed length of its baselines to all dates.
+  Returns the candidate indices sorted best first and their scores.
+  '''
+  if bscale is None:
+    bscale = np.ptp(bperp[0]) or 1.
+  if tscale is None:
+    tscale = np.ptp(tbase[0]) or 1.
+  score = np.sum(np.hypot(bperp / bscale, tbase / tscale), axis=1)
+  order = np.argsort(score)
+  return order, score[order]
 ####################################################
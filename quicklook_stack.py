@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+
+###############################################################################
+#  quicklook_stack.py
+#
+#  Project:
+#  Purpose:  Render quick-look PNGs of the grids of every interferogram
+#  Created:  October 2026
+#
+###############################################################################
+#  Copyright (c) 2026, pygmtsar contributors
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from __future__ import print_function
+import os
+import glob
+import argparse
+import multiprocessing
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+import showintf
+
+####################################################
+def quicklook_name(grid, outdir):
+    '''PNG name for a grid: <intf directory>_<grid name>.png in outdir'''
+    intf_dir = os.path.basename(os.path.dirname(os.path.abspath(grid)))
+    return os.path.join(outdir, intf_dir + '_' + os.path.splitext(os.path.basename(grid))[0] + '.png')
+
+def render_quicklook(args):
+    '''Render one grid to a decimated PNG, skipped if the PNG is newer than the grid'''
+    grid, png, max_size = args
+    if os.path.exists(png) and os.path.getmtime(png) >= os.path.getmtime(grid):
+        return png, False
+    u, factor, window = showintf.read_grid(grid, max_size, overviews=False)
+    cmap, show_stats = showintf.grid_colormap(grid)
+    finite = np.isfinite(u)
+    vmin, vmax = (np.min(u[finite]), np.max(u[finite])) if finite.any() else (None, None)
+    plt.imsave(png, u, cmap=cmap, vmin=vmin, vmax=vmax)
+    return png, True
+
+def write_index(rows, names, outdir):
+    '''Write a contact sheet, index.html, with one row per interferogram and one column per grid'''
+    f = open(os.path.join(outdir, 'index.html'), 'w')
+    f.write('<html><head><title>Quick-looks %s</title></head><body>\n' % os.path.basename(os.getcwd()))
+    f.write('<table>\n<tr><th></th>%s</tr>\n' % ''.join('<th>%s</th>' % n for n in names))
+    for intf_dir in sorted(rows):
+        f.write('<tr><td>%s</td>' % intf_dir)
+        for n in names:
+            png = rows[intf_dir].get(n)
+            if png:
+                png = os.path.basename(png)
+                f.write('<td><a href="%s"><img src="%s" width="200"></a></td>' % (png, png))
+            else:
+                f.write('<td></td>')
+        f.write('</tr>\n')
+    f.write('</table>\n</body></html>\n')
+    f.close()
+
+####################################################
+def parse():
+    '''Command line parser.'''
+    parser = argparse.ArgumentParser(description='Render quick-look PNGs of the grids in every interferogram directory')
+    parser.add_argument('-d', action='store', type=str, dest='intf_dir', default='intf', help='Directory with the interferogram directories (Default: intf)')
+    parser.add_argument('-g', action='store', type=str, nargs='+', dest='names', default=['phasefilt', 'corr', 'unwrap'], help='Grids to render, without .grd (Default: phasefilt corr unwrap)')
+    parser.add_argument('-o', action='store', type=str, dest='outdir', default='quicklook', help='Output directory (Default: quicklook)')
+    parser.add_argument('-max', action='store', type=int, default=500, dest='max_size', help='Max. number of pixels on a side (Default: 500)')
+    parser.add_argument('-n', action='store', type=int, default=multiprocessing.cpu_count(), dest='nproc', help='Number of processes (Default: number of CPUs)')
+    clos = parser.parse_args()
+    return clos
+
+if __name__ == '__main__':
+    clos = parse()
+    if not os.path.exists(clos.outdir):
+        os.makedirs(clos.outdir)
+    jobs = []
+    rows = {}
+    for name in clos.names:
+        for grid in sorted(glob.glob(os.path.join(clos.intf_dir, '*', name + '.grd'))):
+            png = quicklook_name(grid, clos.outdir)
+            rows.setdefault(os.path.basename(os.path.dirname(grid)), {})[name] = png
+            jobs.append((grid, png, clos.max_size))
+    print("Rendering %d grids with %d processes" % (len(jobs), clos.nproc))
+    pool = multiprocessing.Pool(clos.nproc)
+    try:
+        results = pool.map(render_quicklook, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    print("Rendered %d, up to date %d" % (sum(r[1] for r in results), sum(not r[1] for r in results)))
+    write_index(rows, clos.names, clos.outdir)
+    print("Contact sheet: %s" % os.path.join(clos.outdir, 'index.html'))
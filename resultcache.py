@@ -0,0 +1,250 @@
+###############################################################################
+#  resultcache.py
+#
+#  Project:
+#  Purpose:  Content-addressed cache of the results of GMTSAR commands
+#  Created:  October 2026
+#
+###############################################################################
+#  Copyright (c) 2026, pygmtsar contributors
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+'''
+Content-addressed cache of the results of GMTSAR commands.
+
+A command is keyed on its command line and the SHA-1 of each of its input
+files.  On a miss the command runs and its stdout and output files are
+stored; on a hit the stdout is returned and only the output files that are
+missing or changed in the working directory are copied back from the cache.
+File hashes are remembered by path, mtime and size so an unchanged file is
+only hashed once.  Large outputs (the SLC) can be "checked" instead of
+stored: only their hash is recorded and a hit requires the file in the
+working directory to still have that content, so they are never copied.
+
+The cache is on when $GMTSAR_CACHE names its directory (enable() sets it, so
+pool workers use the same cache).  Output files are stored once per content
+in <cache>/objects and the least recently used results are evicted when the
+objects exceed $GMTSAR_CACHE_MB (Default: 20000 MB).
+'''
+
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import threading
+
+CACHE_ENV = 'GMTSAR_CACHE'
+SIZE_ENV = 'GMTSAR_CACHE_MB'
+DEFAULT_SIZE_MB = 20000
+COPY_BUFSIZE = 16*1024*1024
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, sha1 TEXT);
+CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, cmd TEXT, stdout TEXT, outputs TEXT, last_used REAL);
+'''
+
+####################################################
+def enable(cache_dir, max_size_mb=None):
+    '''Cache the commands run by this process and its children in cache_dir'''
+    os.environ[CACHE_ENV] = os.path.abspath(cache_dir)
+    if max_size_mb is not None:
+        os.environ[SIZE_ENV] = str(max_size_mb)
+
+_local = threading.local()
+
+def get_cache():
+    '''Return the ResultCache of $GMTSAR_CACHE or None if caching is off'''
+    cache_dir = os.environ.get(CACHE_ENV)
+    if not cache_dir:
+        return None
+    ### each thread and forked pool worker needs its own database connection ###
+    cache = getattr(_local, 'cache', None)
+    if cache is None or cache.cache_dir != cache_dir or cache.pid != os.getpid():
+        cache = _local.cache = ResultCache(cache_dir, float(os.environ.get(SIZE_ENV, DEFAULT_SIZE_MB)))
+    return cache
+
+####################################################
+class ResultCache(object):
+    '''Cache of the stdout and output files of commands, see the module docstring'''
+
+    def __init__(self, cache_dir, max_size_mb=DEFAULT_SIZE_MB):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1e6
+        self.pid = os.getpid()
+        self.object_dir = os.path.join(cache_dir, 'objects')
+        if not os.path.isdir(self.object_dir):
+            try:
+                os.makedirs(self.object_dir)
+            except OSError:
+                pass # made by another worker
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'cache.db'), timeout=600)
+        self.db.executescript(SCHEMA)
+
+    ##### FILE HASHES #####
+    def remember_hash(self, path, sha1):
+        stat = os.stat(path)
+        self.db.execute('INSERT OR REPLACE INTO hashes VALUES (?,?,?,?)',
+                        (os.path.abspath(path), stat.st_mtime, stat.st_size, sha1))
+        self.db.commit()
+
+    def file_hash(self, path):
+        '''SHA-1 of a file, only read again if its mtime or size changed'''
+        stat = os.stat(path)
+        row = self.db.execute('SELECT mtime, size, sha1 FROM hashes WHERE path=?', (os.path.abspath(path),)).fetchone()
+        if row is not None and (row[0], row[1]) == (stat.st_mtime, stat.st_size):
+            return row[2]
+        sha1 = hashlib.sha1()
+        f = open(path, 'rb')
+        for buf in iter(lambda: f.read(COPY_BUFSIZE), b''):
+            sha1.update(buf)
+        f.close()
+        self.remember_hash(path, sha1.hexdigest())
+        return sha1.hexdigest()
+
+    def key(self, cmd, inputs):
+        key = hashlib.sha1(cmd.encode('utf-8'))
+        for path in inputs:
+            key.update(self.file_hash(path).encode('ascii'))
+        return key.hexdigest()
+
+    ##### OBJECTS #####
+    def object_file(self, sha1):
+        return os.path.join(self.object_dir, sha1)
+
+    def store_file(self, path):
+        '''Copy path into the object store and return its SHA-1 and size'''
+        tmp_file = os.path.join(self.object_dir, 'tmp.%d.%d' % (os.getpid(), threading.current_thread().ident))
+        sha1 = hashlib.sha1()
+        src = open(path, 'rb')
+        dst = open(tmp_file, 'wb')
+        for buf in iter(lambda: src.read(COPY_BUFSIZE), b''):
+            sha1.update(buf)
+            dst.write(buf)
+        src.close()
+        dst.close()
+        digest = sha1.hexdigest()
+        os.rename(tmp_file, self.object_file(digest))
+        self.remember_hash(path, digest)
+        return digest, os.path.getsize(self.object_file(digest))
+
+    def restore_file(self, path, sha1):
+        '''Copy an object back to path unless path already has its content
+
+        Returns False if the object is gone (evicted by another process).
+        '''
+        if os.path.exists(path) and self.file_hash(path) == sha1:
+            return True
+        tmp_file = path + '.cache'
+        try:
+            shutil.copyfile(self.object_file(sha1), tmp_file)
+        except (IOError, OSError):
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return False
+        os.rename(tmp_file, path)
+        self.remember_hash(path, sha1)
+        return True
+
+    ##### RESULTS #####
+    @staticmethod
+    def stored_outputs(outputs):
+        '''Yield (path, sha1, size, stored) of the outputs of a result'''
+        for output in outputs:
+            if len(output) == 3:
+                output = list(output) + [True] # results written before checked outputs
+            yield tuple(output)
+
+    def lookup(self, key):
+        '''Return (stdout, outputs) of a cached result whose objects all exist, otherwise None'''
+        row = self.db.execute('SELECT stdout, outputs FROM results WHERE key=?', (key,)).fetchone()
+        if row is None:
+            return None
+        outputs = list(self.stored_outputs(json.loads(row[1])))
+        if not all(os.path.exists(self.object_file(sha1)) for path, sha1, size, stored in outputs if stored):
+            return None
+        self.db.execute('UPDATE results SET last_used=? WHERE key=?', (time.time(), key))
+        self.db.commit()
+        return row[0], outputs
+
+    def run(self, cmd, inputs, outputs, func, checked=()):
+        '''Return the stdout of cmd, from the cache or by calling func() to run it
+
+        inputs are the files the result depends on, outputs the files the
+        command writes (names relative to the working directory).  checked
+        outputs are not copied to the cache, a hit needs them unchanged in place.
+        '''
+        key = self.key(cmd, inputs)
+        cached = self.lookup(key)
+        if cached is not None:
+            stdout, previous = cached
+            ### unchanged checked outputs, then the stored ones copied back ###
+            if all([os.path.exists(path) and self.file_hash(path) == sha1
+                    for path, sha1, size, stored in previous if not stored]) and \
+               all([self.restore_file(path, sha1) for path, sha1, size, stored in previous if stored]):
+                return stdout
+        stdout = func()
+        if not all(os.path.exists(path) for path in list(outputs) + list(checked)):
+            return stdout # nothing to replay on the next run
+        stored = [(path,) + self.store_file(path) + (True,) for path in outputs]
+        stored += [(path, self.file_hash(path), os.path.getsize(path), False) for path in checked]
+        self.db.execute('INSERT OR REPLACE INTO results VALUES (?,?,?,?,?)',
+                        (key, cmd, stdout, json.dumps(stored), time.time()))
+        self.db.commit()
+        self.evict(key)
+        return stdout
+
+    def evict(self, stored_key=None):
+        '''Drop the least recently used results once the objects exceed the size limit
+
+        Results are kept from the most recently used down; the first one that
+        does not fit and every older one are dropped.  stored_key (the result
+        just stored) is always kept.
+        '''
+        rows = self.db.execute('SELECT key, outputs FROM results ORDER BY last_used DESC').fetchall()
+        rows.sort(key=lambda row: row[0] != stored_key) # stable, the stored result first
+        keep = set()
+        total = 0
+        drop = []
+        for key, outputs in rows:
+            new = dict((sha1, size) for path, sha1, size, stored in self.stored_outputs(json.loads(outputs))
+                       if stored and sha1 not in keep)
+            if drop or (key != stored_key and total + sum(new.values()) > self.max_size):
+                drop.append(key)
+                continue
+            total += sum(new.values())
+            keep.update(new)
+        if not drop:
+            return
+        self.db.executemany('DELETE FROM results WHERE key=?', [(key,) for key in drop])
+        self.db.commit()
+        ### only the objects of the dropped results, other workers may be adding objects ###
+        for key, outputs in rows:
+            if key not in drop:
+                continue
+            for path, sha1, size, stored in self.stored_outputs(json.loads(outputs)):
+                if stored and sha1 not in keep:
+                    keep.add(sha1) # remove once
+                    try:
+                        os.remove(self.object_file(sha1))
+                    except OSError:
+                        pass # already removed by another worker
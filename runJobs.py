@@ -4,38 +4,214 @@
 Created on May 19, 2010
 
 @author: sbaker
+
+Run the commands in a job file (one per line) on a fixed number of processors.
+
+Each command runs as its own subprocess and its exit code is checked.  Finished
+jobs are recorded in a journal next to the job file (<jobfile>.journal) so a
+rerun skips everything that already completed.  Failed jobs are retried up to
+-retry times.  A line containing only "wait" is a barrier: the jobs after it
+only start once every job before it has finished successfully.
+
+numberProcs is the upper limit on concurrent jobs.  With -minfree and/or
+-maxload a new job is only started while the available memory (less the
+memory hint of the job and of recently started jobs) stays above -minfree MB
+and the 1-minute load average stays below -maxload.  Memory hints are read
+from a file given with -memhints, one "<pattern> <MB>" per line where the
+pattern is matched against the command with fnmatch, e.g.
+    *snaphu*     6000
+    p2p_S1A_TOPS* 4000
 '''
 
-import threading
-import Queue
-import sys, os
-
-try:
-    jobFileString = sys.argv[1] ; numberProcs = int(sys.argv[2])
-except:
-    print "Usage:",sys.argv[0], "run_raw2slc numberOfProcessors" ; sys.exit(1)
-
-jobFile = open(jobFileString)
-runJobs = jobFile.readlines()
-jobFile.close()
-
-class Worker(threading.Thread):
-
-    def __init__(self, queue):
-        self.__queue = queue
-        threading.Thread.__init__(self)
-
-    def run(self):
-        while 1:
-            job = self.__queue.get()
-            if job is None:
-                break # reached end of queue
-            # RUN THE COMMAND
-            os.system(job)
-            #print "Finished ", job
-
-# run with limited queue
-queue = Queue.Queue(1)
-for i in range(numberProcs): Worker(queue).start() # start a worker
-for job in runJobs: queue.put(job.rstrip())
-for i in range(numberProcs): queue.put(None) # add end-of-queue markers
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+import fnmatch
+import subprocess as sub
+from collections import deque
+
+BARRIER = 'wait'
+
+####################################################
+def read_jobs(job_file):
+    '''Read the job file and return a list of job groups split at "wait" lines'''
+    groups = [[]]
+    for line in open(job_file):
+        job = line.strip()
+        if not job or job.startswith('#'):
+            continue # skip blank lines and comments
+        if job == BARRIER:
+            groups.append([])
+        else:
+            groups[-1].append(job)
+    return [g for g in groups if g]
+
+####################################################
+def read_journal(journal_file):
+    '''Return the set of jobs recorded as finished in the journal'''
+    done = set()
+    if not os.path.exists(journal_file):
+        return done
+    for line in open(journal_file):
+        c = line.rstrip('\n').split('\t', 3)
+        if len(c) < 4:
+            continue # partial line left by an interrupted run
+        if c[0] == 'done':
+            done.add(c[3])
+    return done
+
+####################################################
+def read_memhints(hint_file):
+    '''Read (pattern, MB) memory hints, first matching pattern wins'''
+    hints = []
+    for line in open(hint_file):
+        c = line.split()
+        if len(c) < 2 or line.startswith('#'):
+            continue
+        hints.append((c[0], float(c[1])))
+    return hints
+
+####################################################
+def available_memory():
+    '''Return the available memory in MB or None if it can't be determined'''
+    try:
+        for line in open('/proc/meminfo'):
+            if line.startswith('MemAvailable:'):
+                return float(line.split()[1]) / 1024.
+    except IOError:
+        pass
+    return None
+
+####################################################
+class Scheduler(object):
+    '''Run jobs as subprocesses, at most num_procs at a time'''
+
+    def __init__(self, num_procs, journal_file, retries=0, poll=0.2):
+        self.num_procs = num_procs
+        self.journal_file = journal_file
+        self.retries = retries
+        self.poll = poll
+        self.running = {}  # Popen -> (job, start time, attempt)
+
+    def can_start(self, job):
+        return len(self.running) < self.num_procs
+
+    def run(self, groups):
+        '''Run each group in turn and return the list of jobs that failed'''
+        done = read_journal(self.journal_file)
+        journal = open(self.journal_file, 'a')
+        failed = []
+        try:
+            for group in groups:
+                pending = [job for job in group if job not in done]
+                if len(pending) < len(group):
+                    print("Skipping %d jobs already finished" % (len(group) - len(pending)))
+                failed = self._run_group(pending, journal)
+                if failed:
+                    print("%d jobs failed, not starting jobs after the barrier" % len(failed))
+                    break
+        finally:
+            journal.close()
+        return failed
+
+    def _run_group(self, jobs, journal):
+        queue = deque((job, 1) for job in jobs)
+        failed = []
+        while queue or self.running:
+            while queue and self.can_start(queue[0][0]):
+                job, attempt = queue.popleft()
+                print("Starting: %s" % job)
+                proc = sub.Popen(job, shell=True)
+                self.running[proc] = (job, time.time(), attempt)
+            finished = [p for p in self.running if p.poll() is not None]
+            if not finished:
+                time.sleep(self.poll)
+                continue
+            for proc in finished:
+                job, start, attempt = self.running.pop(proc)
+                wall = time.time() - start
+                if proc.returncode == 0:
+                    status = 'done'
+                elif attempt <= self.retries:
+                    status = 'retry'
+                    queue.append((job, attempt + 1))
+                else:
+                    status = 'failed'
+                    failed.append(job)
+                print("Finished (%s, exit %d, %.1f s): %s" % (status, proc.returncode, wall, job))
+                journal.write('%s\t%d\t%.1f\t%s\n' % (status, proc.returncode, wall, job))
+                journal.flush()
+        return failed
+
+####################################################
+class AdmissionScheduler(Scheduler):
+    '''Scheduler that also waits for free memory and a low load average'''
+
+    def __init__(self, num_procs, journal_file, retries=0, poll=0.2,
+                 min_free=None, max_load=None, memhints=None, settle=30.):
+        Scheduler.__init__(self, num_procs, journal_file, retries=retries, poll=poll)
+        self.min_free = min_free
+        self.max_load = max_load
+        self.memhints = memhints or []
+        self.settle = settle
+
+    def memory_hint(self, job):
+        for pattern, mb in self.memhints:
+            if fnmatch.fnmatch(job, pattern):
+                return mb
+        return 0.
+
+    def can_start(self, job):
+        if not Scheduler.can_start(self, job):
+            return False
+        if not self.running:
+            return True # always let one job run so the queue can't stall
+        if self.max_load is not None and os.getloadavg()[0] >= self.max_load:
+            return False
+        if self.min_free is not None:
+            avail = available_memory()
+            if avail is not None:
+                ### jobs started recently have not reached their peak memory yet ###
+                now = time.time()
+                ramping = sum(self.memory_hint(j) for j, start, attempt in self.running.values()
+                              if now - start < self.settle)
+                if avail - ramping - self.memory_hint(job) < self.min_free:
+                    return False
+        return True
+
+####################################################
+def parse():
+    '''Command line parser.'''
+    parser = argparse.ArgumentParser(description='Run the commands in a job file in parallel')
+    parser.add_argument('jobFile', action='store', type=str, help='File with one command per line (e.g. run_p2pTOPS)')
+    parser.add_argument('numberProcs', action='store', type=int, help='Number of jobs to run at once')
+    parser.add_argument('-retry', action='store', type=int, default=1, dest='retries', help='Number of times to retry a failed job (Default: 1)')
+    parser.add_argument('-journal', action='store', type=str, dest='journal', help='Journal of finished jobs (Default: <jobFile>.journal)')
+    parser.add_argument('-restart', action='store_true', default=False, help='Ignore the journal and run every job again')
+    parser.add_argument('-minfree', action='store', type=float, dest='min_free', help='Only start a job while this much memory (MB) stays available')
+    parser.add_argument('-maxload', action='store', type=float, dest='max_load', help='Only start a job while the 1-minute load average is below this')
+    parser.add_argument('-memhints', action='store', type=str, dest='memhints', help='File of "<pattern> <MB>" memory hints per command')
+    parser.add_argument('-settle', action='store', type=float, default=30., dest='settle', help='Seconds a new job is assumed to take to reach its memory hint (Default: 30)')
+    clos = parser.parse_args()
+    return clos
+
+if __name__ == '__main__':
+    clos = parse()
+    journal_file = clos.journal or clos.jobFile + '.journal'
+    if clos.restart and os.path.exists(journal_file):
+        os.remove(journal_file)
+    groups = read_jobs(clos.jobFile)
+    start = time.time()
+    memhints = read_memhints(clos.memhints) if clos.memhints else None
+    scheduler = AdmissionScheduler(clos.numberProcs, journal_file, retries=clos.retries,
+                                   min_free=clos.min_free, max_load=clos.max_load,
+                                   memhints=memhints, settle=clos.settle)
+    failed = scheduler.run(groups)
+    print("Total wall time: %.1f s" % (time.time() - start))
+    if failed:
+        print("Failed jobs (rerun %s to retry them):" % sys.argv[0])
+        for job in failed:
+            print("  %s" % job)
+        sys.exit(1)
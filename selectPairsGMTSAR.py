@@ -35,71 +35,333 @@ import os
 import sys
 import shutil
 import datetime
-import itertools
 from operator import itemgetter
 import argparse
 
-import matplotlib.delaunay as md 
+import numpy as np
+import matplotlib.tri as mtri
 import matplotlib.pyplot as plt
 
+import gmtsarutils
+import stackindex
+import stagetrace
+
 def remove_bad_pairs(igramIndices,pbase,tbase,Bcrit,Tcrit):
     ## Remove pairs/interoferogram that have baseline or doppler overlap issues
-    perpBaseMax = Bcrit 
-    goodPairs = []
-    for igram in igramIndices:
-        index1 = igram[0]
-        index2 = igram[1]
-        baseline = pbase[index1] - pbase[index2]
-        if baseline > perpBaseMax or baseline < -perpBaseMax : 
-            continue  # if the baseline is bad, no need to calculate doppler overlap, go to the next igram
-        if (tbase[index2]-tbase[index1]) > Tcrit: # remove pairs exceeding critical temporal baseline
+    igrams = np.asarray(igramIndices, dtype=int).reshape(-1, 2)
+    pbase = np.asarray(pbase, dtype=float)
+    tbase = np.asarray(tbase, dtype=float)
+    baseline = pbase[igrams[:,0]] - pbase[igrams[:,1]]
+    good = (np.abs(baseline) <= Bcrit) & (tbase[igrams[:,1]] - tbase[igrams[:,0]] <= Tcrit)
+    return [tuple(igram) for igram in igrams[good].tolist()]
+
+def delaunay_edges(pbase,tbase):
+    '''Delaunay triangulation of the dates in the (scaled tbase, Bperp) plane
+
+    We apply a weighting factor to the time baseline so that the space being
+    triangulated is symetric (base on Pepe and Lanari (2006)).  Returns the
+    (M, 2) array of edges with the lowest index first, sorted.
+    '''
+    pbase = np.asarray(pbase, dtype=float)
+    tbase = np.asarray(tbase, dtype=float)
+    n = len(tbase)
+    if n < 2:
+        return np.zeros((0, 2), dtype=int)
+    tbaseFac = tbase * (np.ptp(pbase) / np.ptp(tbase) if np.ptp(pbase) > 0 and np.ptp(tbase) > 0 else 1.)
+    try:
+        edges = mtri.Triangulation(tbaseFac, pbase).edges
+    except (RuntimeError, ValueError):
+        ## fewer than 3 dates or all dates on a line, connect consecutive dates
+        edges = np.column_stack((np.arange(n - 1), np.arange(1, n)))
+    edges = np.sort(edges, axis=1)
+    return edges[np.lexsort((edges[:,1], edges[:,0]))]
+
+def build_network(pbase,tbase,Bcrit,Tcrit,lengthDayMax):
+    '''Return the delaunay pairs within Bcrit and Tcrit plus all pairs shorter than lengthDayMax
+
+    Also returns the delaunay edges and the good delaunay pairs on their own.
+    '''
+    edges = delaunay_edges(pbase,tbase)
+    delaunayPairs = remove_bad_pairs(edges,pbase,tbase,Bcrit,Tcrit)
+    shortPairs = candidate_pairs(pbase,tbase,Bcrit,min(Tcrit,lengthDayMax))
+    pairs = sorted(set(delaunayPairs).union(shortPairs))
+    return pairs, edges, delaunayPairs
+
+def candidate_pairs(pbase,tbase,Bcrit,Tcrit):
+    '''Return all pairs (i, j) with i < j within Bcrit (m) and Tcrit (days)
+
+    tbase must be sorted.  Each date is only compared with the dates inside
+    its Tcrit window, found with a binary search on tbase, and the windows are
+    filtered on Bperp with array operations, so the work grows with the number
+    of candidate pairs instead of with N^2.
+    '''
+    pbase = np.asarray(pbase, dtype=float)
+    tbase = np.asarray(tbase, dtype=float)
+    n = len(tbase)
+    first = np.arange(1, n + 1)
+    last = np.searchsorted(tbase, tbase + Tcrit, side='right')
+    counts = np.maximum(last - first, 0)
+    index1 = np.repeat(np.arange(n), counts)
+    index2 = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(first, counts)
+    good = np.abs(pbase[index1] - pbase[index2]) <= Bcrit
+    return list(zip(index1[good].tolist(), index2[good].tolist()))
+
+class UnionFind(object):
+    '''Disjoint sets of date indices with path halving and union by size'''
+
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
+        self.count = n
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        '''Join the sets of i and j, returns False if they were already joined'''
+        i = self.find(i)
+        j = self.find(j)
+        if i == j:
+            return False
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+        self.count -= 1
+        return True
+
+def pair_coherence(igramIndices,pbase,tbase,Bcrit,tau):
+    '''Expected coherence of each pair from a simple decorrelation model
+
+    gamma = exp(-dt/tau) * (1 - |Bperp|/Bcrit), i.e. exponential temporal
+    decorrelation with time constant tau (days) times the geometric
+    decorrelation that reaches zero at the critical baseline.
+    '''
+    igrams = np.asarray(igramIndices, dtype=int).reshape(-1, 2)
+    pbase = np.asarray(pbase, dtype=float)
+    tbase = np.asarray(tbase, dtype=float)
+    dt = np.abs(tbase[igrams[:,1]] - tbase[igrams[:,0]])
+    bperp = np.abs(pbase[igrams[:,1]] - pbase[igrams[:,0]])
+    return np.exp(-dt / tau) * np.clip(1. - bperp / Bcrit, 0., 1.)
+
+def optimal_network(pbase,tbase,Bcrit,Tcrit,tau=60.,redundancy=2,maxPairs=None):
+    '''Select a minimum-cost connected network of pairs
+
+    The candidate pairs within Bcrit and Tcrit cost -log(coherence) (see
+    pair_coherence).  A minimum spanning tree (Kruskal) connects all dates at
+    the lowest cost, then the cheapest remaining pairs are added for dates
+    with fewer than redundancy pairs until maxPairs interferograms are used.
+    Connectivity wins over maxPairs if the spanning tree alone is larger.
+    '''
+    n = len(tbase)
+    igrams = np.array(candidate_pairs(pbase,tbase,Bcrit,Tcrit), dtype=int).reshape(-1, 2)
+    coherence = pair_coherence(igrams,pbase,tbase,Bcrit,tau)
+    igrams = igrams[coherence > 0]
+    cost = -np.log(coherence[coherence > 0])
+    order = np.argsort(cost, kind='mergesort')
+    ## MINIMUM SPANNING TREE ##
+    uf = UnionFind(n)
+    selected = np.zeros(len(igrams), dtype=bool)
+    for k in order:
+        if uf.union(igrams[k,0], igrams[k,1]):
+            selected[k] = True
+    numPairs = int(selected.sum())
+    if uf.count > 1:
+        print("WARNING: candidate pairs only connect the dates in %d separate networks" % uf.count)
+    if maxPairs is not None and numPairs > maxPairs:
+        print("WARNING: %d pairs are needed to connect the network, more than the maximum of %d" % (numPairs,maxPairs))
+    ## ADD THE CHEAPEST PAIRS FOR DATES BELOW THE REDUNDANCY ##
+    degree = np.bincount(igrams[selected].ravel(), minlength=n)
+    for k in order:
+        if maxPairs is not None and numPairs >= maxPairs:
+            break
+        index1, index2 = igrams[k]
+        if not selected[k] and (degree[index1] < redundancy or degree[index2] < redundancy):
+            selected[k] = True
+            degree[index1] += 1
+            degree[index2] += 1
+            numPairs += 1
+    print("optimal network: %d pairs, minimum pairs per date %d, mean expected coherence %.2f" %
+          (numPairs, degree.min() if n else 0, np.exp(-cost[selected]).mean() if numPairs else 0))
+    return sorted(tuple(igram) for igram in igrams[selected].tolist())
+
+def articulation_dates(adjacency):
+    '''Return the dates whose removal splits the network (iterative Tarjan DFS)'''
+    n = len(adjacency)
+    disc = [-1] * n
+    low = [0] * n
+    points = set()
+    timer = 0
+    for root in range(n):
+        if disc[root] != -1:
             continue
-        goodPairs.append(igram)        
-    return goodPairs
+        disc[root] = low[root] = timer
+        timer += 1
+        children = 0
+        stack = [(root, -1, iter(adjacency[root]))]
+        while stack:
+            v, parent, neighbors = stack[-1]
+            for w in neighbors:
+                if disc[w] == -1:
+                    disc[w] = low[w] = timer
+                    timer += 1
+                    stack.append((w, v, iter(adjacency[w])))
+                    break
+                elif w != parent:
+                    low[v] = min(low[v], disc[w])
+            else:
+                stack.pop()
+                if parent == root:
+                    children += 1
+                elif parent != -1:
+                    low[parent] = min(low[parent], low[v])
+                    if low[v] >= disc[parent]:
+                        points.add(parent)
+        if children > 1:
+            points.add(root)
+    return sorted(points)
+
+def analyze_network(pairs,dates):
+    '''Report the connectivity and redundancy of the network of pairs
+
+    Prints the connected components, the articulation dates, the number of
+    pairs per date and the closure loops, and returns them in a dict.
+    '''
+    n = len(dates)
+    uf = UnionFind(n)
+    adjacency = [set() for i in range(n)]
+    for index1, index2 in pairs:
+        uf.union(index1, index2)
+        adjacency[index1].add(index2)
+        adjacency[index2].add(index1)
+    degree = np.array([len(a) for a in adjacency])
+    roots = [uf.find(i) for i in range(n)]
+    sizes = sorted(np.bincount(roots, minlength=n)[sorted(set(roots))].tolist(), reverse=True)
+    articulation = articulation_dates([sorted(a) for a in adjacency])
+    triangles = sum(len([w for w in adjacency[i] & adjacency[j] if w > j]) for i, j in pairs)
+    loops = len(pairs) - n + uf.count
+    print("************************************")
+    print("Network of %d dates and %d pairs" % (n, len(pairs)))
+    print("connected components: %d (dates per component: %s)" % (uf.count, ' '.join(str(size) for size in sizes[:10])))
+    if np.any(degree == 0):
+        print("dates without pairs: %s" % ' '.join(dates[i] for i in np.nonzero(degree == 0)[0]))
+    print("articulation dates: %s" % (' '.join(dates[i] for i in articulation) or 'none'))
+    if n:
+        print("pairs per date: min %d, median %d, max %d" % (degree.min(), np.median(degree), degree.max()))
+        print("dates with a single pair: %d" % np.sum(degree == 1))
+    print("independent closure loops: %d, triangle loops: %d" % (loops, triangles))
+    print("************************************")
+    return {'components': uf.count, 'articulation': articulation, 'degree': degree,
+            'loops': loops, 'triangles': triangles}
+
+def connect_network(pairs,pbase,tbase,Bcrit,Tcrit,tau=60.):
+    '''Return the fewest extra pairs needed to connect the network
+
+    Components are joined by the cheapest candidate pairs within Bcrit and
+    Tcrit (see pair_coherence).  If those are not enough, the remaining
+    components are joined by the pairs of consecutive dates with the
+    smallest baselines.
+    '''
+    n = len(tbase)
+    uf = UnionFind(n)
+    for index1, index2 in pairs:
+        uf.union(index1, index2)
+    extraPairs = []
+    if uf.count == 1:
+        return extraPairs
+    igrams = np.array(candidate_pairs(pbase,tbase,Bcrit,Tcrit), dtype=int).reshape(-1, 2)
+    coherence = pair_coherence(igrams,pbase,tbase,Bcrit,tau)
+    order = np.argsort(-coherence, kind='mergesort')
+    consecutive = np.column_stack((np.arange(n - 1), np.arange(1, n)))
+    pbase = np.asarray(pbase, dtype=float)
+    tbase = np.asarray(tbase, dtype=float)
+    distance = np.hypot(np.diff(pbase) / Bcrit, np.diff(tbase) / tau)
+    for index1, index2 in np.vstack((igrams[order][coherence[order] > 0], consecutive[np.argsort(distance, kind='mergesort')])):
+        if uf.count == 1:
+            break
+        if uf.union(index1, index2):
+            extraPairs.append((int(index1), int(index2)))
+    return sorted(extraPairs)
 
 def get_prm(file):
     file_root = os.path.basename(file.partition('.')[0])  
     prm_file = os.path.dirname(file) + '/' + file_root + ".PRM"
-    prm_dict = {}
-    for line in open(prm_file):
-        c = line.split("=")
-        if len(c) < 2 or line.startswith('%') or line.startswith('#'): 
-            next #ignore commented lines or those without variables
-        else: 
-            prm_dict[c[0].strip()] = str.replace(c[1], '\n', '').strip()
-    return prm_dict
+    return gmtsarutils.read_prm(prm_file)
 
 
+def read_pairs(run_file):
+    '''Read the (SLC, SLC) pairs of an existing job file such as run_p2pTOPS'''
+    pairs = set()
+    if os.path.exists(run_file):
+        for line in open(run_file):
+            c = line.split()
+            if len(c) >= 3:
+                pairs.add((c[1],c[2]))
+    return pairs
+
+def write_pairs(pairs,intf_file,run_file):
+    '''Write the (SLC, SLC) pairs to intf.in and the p2p_S1A_TOPS.csh job file'''
+    intf = open(intf_file,'w')
+    f = open(run_file,'w')
+    for slc1,slc2 in pairs:
+        intf.write(slc1.split("_")[0]+":"+slc2.split("_")[0]+'\n')
+        f.write('p2p_S1A_TOPS.csh %s %s config.tops.txt\n' % (slc1,slc2))
+    intf.close()
+    f.close()
+
 def parse():
     '''Command line parser.'''
     parser = argparse.ArgumentParser(description='Select Interferogram Pairs')
     parser.add_argument('-i', action='store', default='bl_list.txt', dest='infile', help='Baseline List', type=str)
+    parser.add_argument('-db', action='store', default=None, dest='db', help='Read the baselines from the stack index database (e.g. stack.db) instead of the baseline list', type=str)
+    parser.add_argument('-dir', action='store', default=None, dest='slc_dir', help='SLC subdirectory of the baselines to read with -db, e.g. IW1 (needed when the index holds several)', type=str)
     parser.add_argument('-Mmin', dest='monthMin', action='store', default=1, help='Integer of min. month of year (Default: 1 (Jan.))', type=int)
     parser.add_argument('-Mmax', dest='monthMax', action='store', default=12, help='Integer of max. month of year (Default: 12 (Dec.))', type=int)
-    parser.add_argument('-method',action='store', dest='selectMethod',default='del', help='Pairs selection method. all or del(aunay)')
+    parser.add_argument('-method',action='store', dest='selectMethod',default='del', help='Pairs selection method. all, del(aunay) or opt(imal network, see -K, -r and -tau)')
     parser.add_argument('-Bcrit', action='store', default=200.,dest='Bcrit', help='Critical perpendicular baseline (meters)', type=float)
     parser.add_argument('-Tcrit', action='store', default=9999,dest='Tcrit', help='Critical temporal baseline (days)', type=int)
     parser.add_argument('-Dmax', action='store', default=48,dest='lengthDayMax', help='Max. number of days for adding additional pairs', type=int)
+    parser.add_argument('-K', action='store', default=None, dest='maxPairs', help='Max. number of interferograms for -method opt', type=int)
+    parser.add_argument('-r', action='store', default=2, dest='redundancy', help='Min. number of interferograms per date for -method opt (Default: 2)', type=int)
+    parser.add_argument('-tau', action='store', default=60., dest='tau', help='Temporal decorrelation time constant (days) for -method opt (Default: 60)', type=float)
+    parser.add_argument('-connect', action='store_true', default=False, help='Add the fewest pairs needed to connect the network')
     parser.add_argument("-mask", action="store", dest="mask", default='yes')
     parser.add_argument('-span', action='store', dest='dateSpan', help='Date you want ifgrams to span (ie an event of interest)', type=str)
+    parser.add_argument('-update', action='store_true', default=False, help='Keep the pairs in run_p2pTOPS, add only pairs with new dates and write them to run_p2pTOPS_delta and intf_delta.in')
     parser.add_argument("-np", action="store_true", default=False, help='Show network plot')
+    parser.add_argument('-trace', action='store', type=str, dest='trace', help='Append the time and resources of the pair selection to this JSON lines file (see stagetrace.py)')
     clos = parser.parse_args()
     return clos
 
 def main():
     clos = parse()
     print(clos)
-    dat = open(clos.infile,'r').readlines()
-    data = []
-    for d in dat:
-        data.append(d.split())
+    if clos.trace:
+        stagetrace.enable(clos.trace)
+    stage = stagetrace.Stage('pair_selection', method=clos.selectMethod).start()
+    if clos.db:
+        index = stackindex.StackIndex(clos.db)
+        try:
+            data = [list(d) for d in zip(*index.read_baseline_list(clos.slc_dir))]
+        except ValueError as e:
+            sys.exit('ERROR: %s with -dir' % e)
+        index.close()
+    else:
+        dat = open(clos.infile,'r').readlines()
+        data = []
+        for d in dat:
+            data.append(d.split())
   
     dates = []
     tbase = []
     pbase = []
     slcs = []
     prms = []
-    for d in data:
+    for d in sorted(data, key=itemgetter(0)):
       date=datetime.datetime.strptime(d[0],"%Y%m%d")
       if date.month >= clos.monthMin and date.month <= clos.monthMax:
           pbase.append(float(d[1]))
@@ -107,8 +369,17 @@ def main():
           slcs.append(d[3])
           prms.append(os.path.splitext(d[3])[0]+'.PRM')
     print("************************************")
-    print("Total # of scenes in %s: %d" % (clos.infile,len(data)))
+    print("Total # of scenes in %s: %d" % (clos.db or clos.infile,len(data)))
     print("Total after filtering by month: %d" % len(dates))
+    if clos.db:
+        days = [datetime.datetime.strptime(d,"%Y%m%d").toordinal() for d in dates]
+        order, score = gmtsarutils.rank_references(gmtsarutils.pair_baselines(pbase), gmtsarutils.pair_baselines(days))
+    else:
+        bl_dates, bl_perp, bl_par, bl_tbase = gmtsarutils.baseline_matrix(clos.infile)
+        bl_index = dict((d, i) for i, d in enumerate(bl_dates))
+        keep = np.array([bl_index[d] for d in dates])
+        order, score = gmtsarutils.rank_references(bl_perp[np.ix_(keep, keep)], bl_tbase[np.ix_(keep, keep)])
+    print("Best reference date by total network baseline: %s" % dates[order[0]])
     print("************************************")
   
     '''calculate tbase from d1 to dni'''
@@ -119,55 +390,24 @@ def main():
         tbase.append(diff.days)
   
     '''
-    This returns a list of all possible pairs of dates.  Should eliminate
-    those pairs with bad bperp and doppler overlap and leave elimination
-    based on time for later since we can still use them if there is no
-    other alternative.
+    This returns the pairs of dates with good bperp.  Only the "all" method
+    needs every pair within Tcrit, otherwise just the pairs shorter than
+    lengthDayMax are needed to add to the delaunay pairs below.
     '''
-    indexList = []
-    for ni in range(len(dates)): 
-        indexList.append(ni)
-    allPairs = list(itertools.combinations(indexList, 2))    
-    ## Lets remove the ones with bad doppler and baselines
-    print("all possible pairs = " + str(len(allPairs)))
-    allPairs = remove_bad_pairs(allPairs,pbase,tbase,clos.Bcrit,clos.Tcrit)
-    print("all pairs with baselines less than Bcrit (%d m) and Tcrit (%d days): %d" % (clos.Bcrit, clos.Tcrit, len(allPairs)))
+    print("all possible pairs = " + str(len(dates)*(len(dates)-1)//2))
+    if clos.selectMethod == 'all':
+        allPairs = candidate_pairs(pbase,tbase,clos.Bcrit,clos.Tcrit)
+        print("all pairs with baselines less than Bcrit (%d m) and Tcrit (%d days): %d" % (clos.Bcrit, clos.Tcrit, len(allPairs)))
   
     ''' 
     Do a delaunay triangulation to find the "best" pairs.
-    The edges will contain index to the pairs we need. We apply a 
-    weighting factor to the time baseline so that the space being
-    triangulated is symetric (base on Pepe and Lanari (2006))
-  
     After the pairs are selected we then eliminate pairs which 
     are not "good" due to perpendicular baseline and doppler overlap.
     We then add in the pairs with short temporal baselines (lengthDayMax).  
     '''
-    tbaseFac = []
-    for idx in range(len(tbase)): tbaseFac.append(tbase[idx] * (max(pbase) - min(pbase)) / (max(tbase)))
-    centers, edges, tri, neighbors = md.delaunay(tbaseFac, pbase)
-    delaunayPairs = edges.tolist()
-    '''
-    The delaunay pairs do not necessarily have the indexes with lowest 
-    first, so let's arrange and sort the delaunay pairs
-    '''
-    for idx in range(len(delaunayPairs)):
-        if delaunayPairs[idx][0] > delaunayPairs[idx][1]:
-            index1 = delaunayPairs[idx][1]
-            index2 = delaunayPairs[idx][0]
-            delaunayPairs[idx][0] = index1
-            delaunayPairs[idx][1] = index2
-    delaunayPairs = sorted(delaunayPairs, key=itemgetter(0)) 
-    ## Lets remove the ones with bad doppler and baselines
-    print("delaunay possible pairs = " + str(len(delaunayPairs)))
-    delaunayPairs = remove_bad_pairs(delaunayPairs,pbase,tbase,clos.Bcrit,clos.Tcrit)
-    print("delaunay pairs with baselines less than Bcrit (%d m) and Tcrit (%d days): %d"  % (clos.Bcrit,clos.Tcrit,len(delaunayPairs)))
-    ## Now lets add all additional pairs less than lengthDayMax from allPairs
-    for idx in range(len(allPairs)):
-        allPairs[idx] = list(allPairs[idx])
-        if tbase[allPairs[idx][1]] - tbase[allPairs[idx][0]] <= clos.lengthDayMax:
-            if allPairs[idx] not in delaunayPairs: 
-                delaunayPairs.append(allPairs[idx])
+    delaunayPairs, edges, goodDelaunayPairs = build_network(pbase,tbase,clos.Bcrit,clos.Tcrit,clos.lengthDayMax)
+    print("delaunay possible pairs = " + str(len(edges)))
+    print("delaunay pairs with baselines less than Bcrit (%d m) and Tcrit (%d days): %d"  % (clos.Bcrit,clos.Tcrit,len(goodDelaunayPairs)))
     print("delaunay pairs with added pairs less than " + str(clos.lengthDayMax) + " days = " + str(len(delaunayPairs)))
   
     projectDir = os.getcwd()
@@ -175,6 +415,8 @@ def main():
   
     if clos.selectMethod == 'all':
         pairs = allPairs
+    elif clos.selectMethod == 'opt':
+        pairs = optimal_network(pbase,tbase,clos.Bcrit,clos.Tcrit,clos.tau,clos.redundancy,clos.maxPairs)
     else:
         pairs = delaunayPairs
   
@@ -185,18 +427,30 @@ def main():
         pairs = [igram for igram in pairs if dates_obj[igram[0]]<date_span and dates_obj[igram[1]]>date_span ]
         print("# of pairs spanning %s: %d" % (clos.dateSpan,len(pairs)))
   
-    intf = open('intf.in','w')
-    f = open('run_p2pTOPS','w')
-    for igram in sorted(pairs):
-        ndx1 = igram[0]
-        ndx2 = igram[1]
-        baseline = '%05.0f' % round(pbase[ndx1]-pbase[ndx2])
-        temporalbaseline = '%04.0f' % round(tbase[ndx2]-tbase[ndx1])
-#        print(slcs[ndx1].split("_")[0]+":"+slcs[ndx2].split("_")[0])
-        intf.write(slcs[ndx1].split("_")[0]+":"+slcs[ndx2].split("_")[0]+'\n')
-        f.write('p2p_S1A_TOPS.csh %s %s config.tops.txt\n' % (os.path.splitext(slcs[ndx1])[0],os.path.splitext(slcs[ndx2])[0])) 
-    intf.close()
-    f.close()
+    networkStats = analyze_network(pairs,dates)
+    stage.info.update(dates=len(dates), pairs=len(pairs))
+    if clos.connect and networkStats['components'] > 1:
+        extraPairs = connect_network(pairs,pbase,tbase,clos.Bcrit,clos.Tcrit,clos.tau)
+        print("adding %d pairs to connect the network" % len(extraPairs))
+        pairs = sorted(set(pairs).union(extraPairs))
+        analyze_network(pairs,dates)
+
+    names = [os.path.splitext(slc)[0] for slc in slcs]
+    newPairs = []
+    if clos.update:
+        """ Keep the existing pairs and only add the pairs with a date that is not in them yet """
+        oldPairs = read_pairs('run_p2pTOPS')
+        oldNames = set(name for pair in oldPairs for name in pair)
+        newDates = [names[idx] for idx in range(len(names)) if names[idx] not in oldNames]
+        newPairs = [igram for igram in sorted(pairs)
+                    if (names[igram[0]] not in oldNames or names[igram[1]] not in oldNames)
+                    and (names[igram[0]],names[igram[1]]) not in oldPairs]
+        print("existing pairs: %d, new dates: %d, new pairs: %d" % (len(oldPairs),len(newDates),len(newPairs)))
+        write_pairs([(names[i],names[j]) for i,j in newPairs],'intf_delta.in','run_p2pTOPS_delta')
+        namePairs = sorted(oldPairs.union((names[i],names[j]) for i,j in newPairs))
+    else:
+        namePairs = [(names[i],names[j]) for i,j in sorted(pairs)]
+    write_pairs(namePairs,'intf.in','run_p2pTOPS')
 
     f = open('config.tops.txt','w')
     f.write('proc_stage = 4\n')
@@ -210,6 +464,7 @@ def main():
     f.write('defomax = 0\n')
     f.write('threshold_geocode = .10')
     f.close()
+    stage.stop()
 
     plt.figure()
     for e in edges:
@@ -222,6 +477,10 @@ def main():
         x = [dates_obj[ndx1], dates_obj[ndx2]]
         y = [pbase[ndx1], pbase[ndx2]]
         plt.plot(x, y, 'b')
+    for igram in newPairs:
+        x = [dates_obj[igram[0]], dates_obj[igram[1]]]
+        y = [pbase[igram[0]], pbase[igram[1]]]
+        plt.plot(x, y, 'm')
     plt.plot(dates_obj, pbase, 'ro')
     if clos.dateSpan:
         plt.axvline(datetime.datetime.strptime(clos.dateSpan,'%Y-%m-%d'),ls='-',color='g')
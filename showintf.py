@@ -2,6 +2,7 @@
 from __future__ import print_function
 import os
 import sys
+import argparse
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -34,21 +35,100 @@ def dismph_colormap():
     dismphCM.set_bad('w', 0.0)
     return dismphCM
 
-infile = sys.argv[1]
-
-#os.environ['GDAL_NETCDF_BOTTOMUP'] = 'NO'
-u = gdal.Open(infile).ReadAsArray() #[3000:4300,500:1500]
-
-if 'unwrap' in infile:
-    print(np.nanmin(u),np.nanmax(u))
-#    plt.imshow(u,cmap=plt.cm.RdBu,clim=[-10,10])
-    plt.imshow(u,cmap=plt.cm.RdBu)
-elif 'amp' in infile or 'mli' in infile:
-    print(np.nanmin(u),np.nanmax(u))
-    plt.imshow(u,cmap=plt.cm.gray)
-elif 'corr' in infile:
-    print(np.nanmin(u),np.nanmax(u))
-    plt.imshow(u)
-else:
-    plt.imshow(u,cmap=dismph_colormap())
-plt.show()
+###############################################################################
+def grid_colormap(infile):
+    '''Pick the colormap from the file name
+
+    Returns the colormap (None for the default) and whether the min/max of
+    the grid should be printed.
+    '''
+    if 'unwrap' in infile:
+        return plt.cm.RdBu, True
+    elif 'amp' in infile or 'mli' in infile:
+        return plt.cm.gray, True
+    elif 'corr' in infile:
+        return None, True
+    else:
+        return dismph_colormap(), False
+
+###############################################################################
+def build_overviews(ds, factor):
+    '''Build nearest neighbour overviews down to the decimation factor
+
+    For grids opened read-only GDAL writes them to an external .ovr file, so
+    this only costs a full read the first time a grid is viewed.
+    '''
+    levels = []
+    level = 2
+    while level <= factor:
+        levels.append(level)
+        level *= 2
+    if levels:
+        print("Building overviews %s" % levels)
+        ds.BuildOverviews('NEAREST', levels)
+
+def read_grid(infile, max_size=2000, window=None, overviews=True):
+    '''Read a grid decimated to at most max_size pixels on a side
+
+    window is (xoff, yoff, xsize, ysize) in full resolution pixels, by default
+    the whole grid.  GDAL reads the decimated array from the overviews when
+    there are any, so only a fraction of the grid is read.  Returns the array,
+    the decimation factor and the window.
+    '''
+    ds = gdal.Open(infile)
+    band = ds.GetRasterBand(1)
+    if window is None:
+        window = (0, 0, ds.RasterXSize, ds.RasterYSize)
+    xoff, yoff, xsize, ysize = window
+    factor = max(1, int(np.ceil(max(xsize, ysize) / float(max_size))))
+    if overviews and factor > 1 and band.GetOverviewCount() == 0:
+        build_overviews(ds, factor)
+        band = ds.GetRasterBand(1)
+    u = band.ReadAsArray(xoff, yoff, xsize, ysize,
+                         buf_xsize=max(1, xsize // factor), buf_ysize=max(1, ysize // factor))
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        u = u.astype(np.float32)
+        u[u == nodata] = np.nan
+    return u, factor, window
+
+def grid_minmax(infile, chunk_pixels=2**24):
+    '''nanmin and nanmax of a full resolution grid in a streaming pass over blocks of rows'''
+    ds = gdal.Open(infile)
+    band = ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    rows = max(band.GetBlockSize()[1], chunk_pixels // ds.RasterXSize)
+    vmin, vmax = np.inf, -np.inf
+    for yoff in range(0, ds.RasterYSize, rows):
+        a = band.ReadAsArray(0, yoff, ds.RasterXSize, min(rows, ds.RasterYSize - yoff))
+        a = a[np.isfinite(a)] if nodata is None else a[np.isfinite(a) & (a != nodata)]
+        if a.size:
+            vmin = min(vmin, a.min())
+            vmax = max(vmax, a.max())
+    return vmin, vmax
+
+###############################################################################
+def parse():
+    '''Command line parser.'''
+    parser = argparse.ArgumentParser(description='Display a GMTSAR grid')
+    parser.add_argument('infile', action='store', type=str, help='Grid to display (phasefilt, corr, unwrap, ...)')
+    parser.add_argument('-max', action='store', type=int, default=2000, dest='max_size', help='Max. number of pixels on a side to display (Default: 2000)')
+    parser.add_argument('-window', action='store', type=int, nargs=4, dest='window', metavar=('XOFF','YOFF','XSIZE','YSIZE'), help='Only read this window of the grid')
+    parser.add_argument('-noovr', action='store_false', default=True, dest='overviews', help='Do not build overviews for large grids')
+    parser.add_argument('-fullstats', action='store_true', default=False, help='Compute min/max from the full resolution grid instead of the displayed one')
+    clos = parser.parse_args()
+    return clos
+
+if __name__ == '__main__':
+    clos = parse()
+    infile = clos.infile
+    #os.environ['GDAL_NETCDF_BOTTOMUP'] = 'NO'
+    u, factor, (xoff, yoff, xsize, ysize) = read_grid(infile, clos.max_size, clos.window, clos.overviews)
+    cmap, show_stats = grid_colormap(infile)
+    if show_stats:
+        if clos.fullstats:
+            print(*grid_minmax(infile))
+        else:
+            print(np.nanmin(u),np.nanmax(u))
+    plt.imshow(u, cmap=cmap, extent=[xoff, xoff + xsize, yoff + ysize, yoff], interpolation='nearest')
+    plt.show()
@@ -0,0 +1,197 @@
+###############################################################################
+#  stackindex.py
+#
+#  Project:
+#  Purpose:  SQLite index of the metadata of a stack of SLCs
+#  Created:  October 2026
+#
+###############################################################################
+#  Copyright (c) 2026, pygmtsar contributors
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import os
+import json
+import glob
+import sqlite3
+import datetime
+
+import numpy as np
+
+import gmtsarutils
+
+DB_NAME = 'stack.db'
+TIME_FMT = "%Y-%m-%dT%H:%M:%S.%f"
+DATETIME_KEYS = ('startTime', 'stopTime')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER);
+CREATE TABLE IF NOT EXISTS prm (path TEXT PRIMARY KEY, params TEXT);
+CREATE TABLE IF NOT EXISTS xml (path TEXT PRIMARY KEY, meta TEXT);
+CREATE TABLE IF NOT EXISTS baselines (reference TEXT, path TEXT, signature TEXT, bperp REAL, bpar REAL,
+                                      PRIMARY KEY (reference, path));
+CREATE TABLE IF NOT EXISTS bl_list (slc_dir TEXT, date TEXT, bperp REAL, bpar REAL, slc TEXT,
+                                    PRIMARY KEY (slc_dir, date));
+'''
+
+####################################################
+class StackIndex(object):
+    '''SQLite index of the PRM, annotation XML and baseline metadata of a stack
+
+    Every file that goes into the index is recorded with its mtime and size,
+    and its entry is only re-read when either changes.  The scripts query
+    the index instead of globbing and parsing the whole stack again.  By
+    default the database is stack.db in the project directory.
+    '''
+    def __init__(self, db_file=DB_NAME):
+        self.db_file = os.path.abspath(db_file)
+        self.db = sqlite3.connect(self.db_file)
+        ### bl_list of an older index has no slc_dir, it is rebuilt by the next write_baseline_list ###
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(bl_list)')]
+        if columns and 'slc_dir' not in columns:
+            self.db.execute('DROP TABLE bl_list')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    ##### FILE MODIFICATION TRACKING #####
+    def file_stat(self, path):
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+
+    def is_current(self, path):
+        '''Check whether path is unchanged since it was last indexed'''
+        row = self.db.execute('SELECT mtime, size FROM files WHERE path=?', (os.path.abspath(path),)).fetchone()
+        return row is not None and os.path.exists(path) and tuple(row) == self.file_stat(path)
+
+    def record_file(self, path):
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?,?,?)', (os.path.abspath(path),) + self.file_stat(path))
+
+    ##### PRM FILES #####
+    def prm(self, prm_file):
+        '''Return the PRM parameters (as strings) of prm_file, re-read only if the file changed'''
+        path = os.path.abspath(prm_file)
+        if self.is_current(prm_file):
+            row = self.db.execute('SELECT params FROM prm WHERE path=?', (path,)).fetchone()
+            if row is not None:
+                return json.loads(row[0])
+        params = gmtsarutils.read_prm(prm_file)
+        self.db.execute('INSERT OR REPLACE INTO prm VALUES (?,?)', (path, json.dumps(params)))
+        self.record_file(prm_file)
+        self.db.commit()
+        return params
+
+    def prms(self, directory='.', pattern='*.PRM'):
+        '''Return a dict of base file name -> PRM parameters for every PRM in a directory'''
+        return dict((os.path.basename(p), self.prm(p)) for p in sorted(glob.glob(os.path.join(directory, pattern))))
+
+    ##### ANNOTATION XML #####
+    def xml_meta(self, xml_file):
+        '''Return the indexed parse_subswath_xml dict for xml_file or None if it changed'''
+        if not self.is_current(xml_file):
+            return None
+        row = self.db.execute('SELECT meta FROM xml WHERE path=?', (os.path.abspath(xml_file),)).fetchone()
+        if row is None:
+            return None
+        meta_dict = json.loads(row[0])
+        for key in DATETIME_KEYS:
+            if key in meta_dict:
+                meta_dict[key] = datetime.datetime.strptime(meta_dict[key], TIME_FMT)
+        return meta_dict
+
+    def add_xml_meta(self, xml_file, meta_dict):
+        meta = dict(meta_dict)
+        for key in DATETIME_KEYS:
+            if key in meta:
+                meta[key] = meta[key].strftime(TIME_FMT)
+        self.db.execute('INSERT OR REPLACE INTO xml VALUES (?,?)', (os.path.abspath(xml_file), json.dumps(meta)))
+        self.record_file(xml_file)
+        self.db.commit()
+
+    def parse_xml(self, xml_file, parser):
+        '''Return the metadata of xml_file from the index, running parser(xml_file) if it is not current'''
+        meta_dict = self.xml_meta(xml_file)
+        if meta_dict is None:
+            meta_dict = parser(xml_file)
+            self.add_xml_meta(xml_file, meta_dict)
+        return meta_dict
+
+    ##### BASELINES #####
+    def baseline_signature(self, ref_prm_file, prm_file):
+        '''mtimes of the reference and scene PRM and LED files the baseline depends on'''
+        files = []
+        for p in (ref_prm_file, prm_file):
+            files.append(p)
+            files.append(os.path.join(os.path.dirname(p), self.prm(p)['led_file']))
+        return ' '.join('%.6f' % os.path.getmtime(f) for f in files)
+
+    def baselines(self, ref_prm_file, prm_files):
+        '''Return the B_perpendicular and B_parallel arrays of prm_files relative to ref_prm_file
+
+        Baselines are taken from the index when none of their PRM or LED files
+        changed, the others are computed with gmtsarutils.orbit_baselines.
+        '''
+        reference = os.path.abspath(ref_prm_file)
+        bperp = np.zeros(len(prm_files))
+        bpar = np.zeros(len(prm_files))
+        signatures = [self.baseline_signature(ref_prm_file, p) for p in prm_files]
+        stale = []
+        for i, (prm_file, signature) in enumerate(zip(prm_files, signatures)):
+            row = self.db.execute('SELECT signature, bperp, bpar FROM baselines WHERE reference=? AND path=?',
+                                  (reference, os.path.abspath(prm_file))).fetchone()
+            if row is not None and row[0] == signature:
+                bperp[i], bpar[i] = row[1], row[2]
+            else:
+                stale.append(i)
+        if stale:
+            bperp[stale], bpar[stale] = gmtsarutils.orbit_baselines(ref_prm_file, [prm_files[i] for i in stale])
+            self.db.executemany('INSERT OR REPLACE INTO baselines VALUES (?,?,?,?,?)',
+                                [(reference, os.path.abspath(prm_files[i]), signatures[i], bperp[i], bpar[i]) for i in stale])
+            self.db.commit()
+        return bperp, bpar
+
+    ##### BASELINE LIST (bl_list.txt) #####
+    def write_baseline_list(self, slc_dir, dates, bperp, bpar, slcs):
+        '''Replace the indexed baseline list of one SLC subdirectory (e.g. IW1), the same rows as its bl_list.txt'''
+        self.db.execute('DELETE FROM bl_list WHERE slc_dir=?', (slc_dir,))
+        self.db.executemany('INSERT INTO bl_list VALUES (?,?,?,?,?)',
+                            [(slc_dir, d, float(bp), float(bl), s) for d, bp, bl, s in zip(dates, bperp, bpar, slcs)])
+        self.db.commit()
+
+    def baseline_dirs(self):
+        '''SLC subdirectories with an indexed baseline list'''
+        return [str(r[0]) for r in self.db.execute('SELECT DISTINCT slc_dir FROM bl_list ORDER BY slc_dir')]
+
+    def read_baseline_list(self, slc_dir=None):
+        '''Return the dates, Bperp, Bpar and SLC names of the indexed baseline list of slc_dir
+
+        slc_dir can be left out when the index holds the baselines of one
+        subdirectory only, otherwise a ValueError names the choices.
+        '''
+        if slc_dir is None:
+            slc_dirs = self.baseline_dirs()
+            if len(slc_dirs) > 1:
+                raise ValueError('%s holds the baselines of %s, choose one' % (self.db_file, ', '.join(slc_dirs)))
+            slc_dir = slc_dirs[0] if slc_dirs else ''
+        rows = self.db.execute('SELECT date, bperp, bpar, slc FROM bl_list WHERE slc_dir=? ORDER BY date', (slc_dir,)).fetchall()
+        return ([str(r[0]) for r in rows], np.array([r[1] for r in rows]),
+                np.array([r[2] for r in rows]), [str(r[3]) for r in rows])
@@ -0,0 +1,191 @@
+#! /usr/bin/env python
+
+###############################################################################
+#  stagetrace.py
+#
+#  Project:
+#  Purpose:  Time and resource trace of the processing stages
+#  Created:  October 2026
+#
+###############################################################################
+#  Copyright (c) 2026, pygmtsar contributors
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+'''
+Trace the wall time, CPU time, peak memory and disk I/O of each processing
+stage and GMTSAR command to a JSON lines file.
+
+Tracing is on when $GMTSAR_TRACE names the trace file (enable() sets it, so
+pool workers and child scripts append to the same file).  Each record is one
+line:
+    {"stage": "make_s1a_tops", "parent": "make_slc", "pid": 1234,
+     "start": 1476800000.0, "wall": 12.3, "cpu": 11.9, "maxrss_mb": 850.2,
+     "read_mb": 1310.7, "write_mb": 1250.1, "info": {...}}
+cpu, read_mb and write_mb include the child processes finished during the
+stage (from getrusage), I/O is what reached the disk (block input/output).
+maxrss_mb is the high-water mark of this process or any finished child.
+Stages that overlap in threads of one process share these counters.
+
+Run as a script to summarize a trace:
+    stagetrace.py trace.jsonl
+'''
+
+from __future__ import print_function
+import os
+import json
+import time
+import resource
+import argparse
+import threading
+
+TRACE_ENV = 'GMTSAR_TRACE'
+BLOCK_SIZE = 512.
+_local = threading.local()
+
+####################################################
+def enable(trace_file):
+    '''Append the trace of this process and its children to trace_file'''
+    os.environ[TRACE_ENV] = os.path.abspath(trace_file)
+
+def trace_file():
+    return os.environ.get(TRACE_ENV)
+
+def _stack():
+    '''Names of the stages open in this thread'''
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def usage():
+    '''Return cpu seconds, peak RSS in MB and MB read/written so far, this process and its children'''
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    maxrss = max(own.ru_maxrss, children.ru_maxrss) / 1024.  # kB on Linux
+    read_mb = (own.ru_inblock + children.ru_inblock) * BLOCK_SIZE / 1e6
+    write_mb = (own.ru_oublock + children.ru_oublock) * BLOCK_SIZE / 1e6
+    return cpu, maxrss, read_mb, write_mb
+
+class Stage(object):
+    '''Context manager that writes a trace record for the enclosed stage
+
+    with stagetrace.Stage('extract', zips=len(zip_list)):
+        ...
+
+    or stage = stagetrace.Stage('extract').start() ... stage.stop()
+
+    Does nothing when tracing is off.  Extra keyword arguments go into the
+    record as "info", and are also settable on stage.info inside the block.
+    '''
+    def __init__(self, name, **info):
+        self.name = name
+        self.info = info
+
+    def start(self):
+        self.trace_file = trace_file()
+        if self.trace_file:
+            stack = _stack()
+            self.parent = stack[-1] if stack else None
+            stack.append(self.name)
+            self.start_time = time.time()
+            self.start_usage = usage()
+        return self
+
+    def stop(self, exc_type=None, exc_value=None):
+        if not self.trace_file:
+            return
+        _stack().pop()
+        wall = time.time() - self.start_time
+        cpu, maxrss, read_mb, write_mb = usage()
+        record = {'stage': self.name, 'parent': self.parent, 'pid': os.getpid(),
+                  'start': round(self.start_time, 3), 'wall': round(wall, 3),
+                  'cpu': round(cpu - self.start_usage[0], 3), 'maxrss_mb': round(maxrss, 1),
+                  'read_mb': round(read_mb - self.start_usage[2], 3),
+                  'write_mb': round(write_mb - self.start_usage[3], 3)}
+        if exc_type is not None:
+            record['error'] = '%s: %s' % (exc_type.__name__, exc_value)
+        if self.info:
+            record['info'] = self.info
+        ### one write per record so concurrent processes don't interleave lines ###
+        f = open(self.trace_file, 'a')
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+        f.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop(exc_type, exc_value)
+        return False
+
+####################################################
+def read_trace(trace_file):
+    records = []
+    for line in open(trace_file):
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            pass # partial line of an interrupted run
+    return records
+
+def summarize(records):
+    '''Return one row per stage: name, calls, total/mean/max wall, cpu, peak RSS, MB read/written'''
+    stages = {}
+    for r in records:
+        s = stages.setdefault(r['stage'], {'calls': 0, 'wall': 0., 'max_wall': 0., 'cpu': 0.,
+                                           'maxrss_mb': 0., 'read_mb': 0., 'write_mb': 0., 'errors': 0})
+        s['calls'] += 1
+        s['wall'] += r['wall']
+        s['max_wall'] = max(s['max_wall'], r['wall'])
+        s['cpu'] += r['cpu']
+        s['maxrss_mb'] = max(s['maxrss_mb'], r['maxrss_mb'])
+        s['read_mb'] += r['read_mb']
+        s['write_mb'] += r['write_mb']
+        s['errors'] += 'error' in r or r.get('info', {}).get('returncode', 0) != 0
+    return sorted(stages.items(), key=lambda item: -item[1]['wall'])
+
+def print_summary(records):
+    if not records:
+        print("No records")
+        return
+    span = max(r['start'] + r['wall'] for r in records) - min(r['start'] for r in records)
+    print("%-24s %6s %10s %9s %9s %10s %9s %10s %10s %6s" % ('stage', 'calls', 'wall(s)', 'mean(s)', 'max(s)',
+          'cpu(s)', 'rss(MB)', 'read(MB)', 'write(MB)', 'errors'))
+    for name, s in summarize(records):
+        print("%-24s %6d %10.1f %9.2f %9.2f %10.1f %9.1f %10.1f %10.1f %6d" % (name, s['calls'], s['wall'],
+              s['wall'] / s['calls'], s['max_wall'], s['cpu'], s['maxrss_mb'], s['read_mb'], s['write_mb'], s['errors']))
+    print("Elapsed time of the trace: %.1f s" % span)
+    print("Stages include the time of the stages and commands they run (see \"parent\" in the trace)")
+
+def parse():
+    '''Command line parser.'''
+    parser = argparse.ArgumentParser(description='Summarize a stage trace written with -trace or $%s' % TRACE_ENV)
+    parser.add_argument('trace', action='store', type=str, help='Trace file (JSON lines)')
+    parser.add_argument('-parent', action='store', type=str, dest='parent', help='Only summarize the stages run inside this stage')
+    clos = parser.parse_args()
+    return clos
+
+if __name__ == '__main__':
+    clos = parse()
+    records = read_trace(clos.trace)
+    if clos.parent:
+        records = [r for r in records if r.get('parent') == clos.parent]
+    print_summary(records)
@@ -36,187 +36,735 @@ import sys
 import argparse
 import datetime
 import zipfile
-import fnmatch
 import shutil
-from xml.etree import ElementTree as ET
+import zlib
+import json
+import multiprocessing
+try:
+    from xml.etree import cElementTree as ET
+except ImportError:
+    from xml.etree import ElementTree as ET
 import glob
 import re
+import bisect
 import urllib2
 
 import numpy as np
 
 import gmtsarutils
+import stackindex
+import stagetrace
+import resultcache
 
 ####################################################
-def extract_tiff_xml(infile,swath_num):
+def run_pool(func,args,nproc=1):
+    '''Map func over args with a pool of nproc processes, results are in the order of args'''
+    if nproc <= 1:
+        return [func(a) for a in args]
+    pool = multiprocessing.Pool(nproc)
+    try:
+        results = pool.map(func, args, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+####################################################
+COPY_BUFSIZE = 16*1024*1024
+
+def member_is_current(info, outfile, verify_crc=False):
+    '''Check that outfile is a complete copy of the ZIP member described by info
+
+    The size is always checked, the CRC only if verify_crc is set since it
+    means reading the whole file back.
+    '''
+    if not os.path.exists(outfile) or os.path.getsize(outfile) != info.file_size:
+        return False
+    if verify_crc:
+        crc = 0
+        f = open(outfile,'rb')
+        for block in iter(lambda: f.read(COPY_BUFSIZE), b''):
+            crc = zlib.crc32(block, crc)
+        f.close()
+        return (crc & 0xffffffff) == info.CRC
+    return True
+
+def extract_member(input_zip, info, outfile):
+    '''Copy a ZIP member to outfile through a temporary file so a crash never leaves a partial outfile'''
+    tmpfile = outfile + '.part'
+    source = input_zip.open(info)
+    target = open(tmpfile,'wb')
+    shutil.copyfileobj(source,target,COPY_BUFSIZE)
+    target.close()
+    source.close()
+    os.rename(tmpfile, outfile)
+
+SLC_MEMBER_RE = re.compile(r'.*/(annotation|measurement)/(s1[ab])-(iw[1-3])-slc-(vv|vh|hh|hv)-.*\.(xml|tiff)$')
+CO_POLS = ('vv','hh')
+
+def slc_dir_name(swath,pol,by_pol=False):
+    '''SLC subdirectory of a swath, e.g. IW1, or IW1_VH when several polarisations are prepared'''
+    if by_pol:
+        return '%s_%s' % (swath.upper(),pol.upper())
+    return swath.upper()
+
+def extract_tiff_xml(infile,swaths,pols=None,verify_crc=False,aoi=None,burst_ids=None):
+    '''Extract the TIFF and XML of the swaths and polarisations from one ZIP in a single pass
+
+    swaths are the swath numbers as strings, pols the polarisations or None
+    for the co-polarisation (VV or HH).  Each swath goes to its own SLC
+    subdirectory (see slc_dir_name), which must exist.  With an AOI or burst
+    IDs only the selected bursts are kept (see extract_bursts).  Returns a
+    dict of subdirectory -> [tiff, xml] (paths relative to the SLC directory).
+    '''
+    by_pol = pols is not None and len(pols) > 1
+    wanted_swaths = set('iw'+s for s in swaths)
+    wanted_pols = set(p.lower() for p in pols) if pols else set(CO_POLS)
     input_zip = zipfile.ZipFile(infile)
-    for t in input_zip.namelist():
-        if fnmatch.fnmatch(t,'*annotation/s1a-iw'+swath_num+'-slc-vv*.xml') or fnmatch.fnmatch(t,'*annotation/s1a-iw'+swath_num+'-slc-hh*.xml'):
-#            print("extracting %s" % t)
-            xml = os.path.basename(t)
-            if os.path.exists(xml): continue
-            source = input_zip.open(t)
-            target = open(xml,'wb')
-            shutil.copyfileobj(source,target)
-            target.close()
-            source.close()
-        if fnmatch.fnmatch(t,'*measurement/s1a-iw'+swath_num+'-slc-vv*tiff') or fnmatch.fnmatch(t,'*measurement/s1a-iw'+swath_num+'-slc-hh*tiff'):
-#            print("extracting %s" % t)
-            tiff = os.path.basename(t)
-            if os.path.exists(tiff): continue
-            source = input_zip.open(t)
-            target = open(tiff,'wb')
-            shutil.copyfileobj(source,target)
-            target.close()
-            source.close()
+    members = {}
+    for info in input_zip.infolist():
+        m = SLC_MEMBER_RE.match(info.filename)
+        if not m or m.group(3) not in wanted_swaths or m.group(4) not in wanted_pols:
+            continue
+        slc_dir = slc_dir_name(m.group(3),m.group(4),by_pol)
+        members.setdefault(slc_dir,[None,None])[1 if m.group(1) == 'annotation' else 0] = info
+    extracted = {}
+    for slc_dir,(tiff_info,xml_info) in sorted(members.items()):
+        if aoi or burst_ids:
+            if tiff_info and xml_info:
+                cropped = extract_bursts(infile,input_zip,tiff_info,xml_info,slc_dir,aoi,burst_ids)
+                if cropped:
+                    extracted[slc_dir] = cropped
+                    continue
+        files = extracted[slc_dir] = [None,None]
+        for i,info in enumerate([tiff_info,xml_info]):
+            if info is None:
+                continue
+            files[i] = outfile = os.path.join(slc_dir,os.path.basename(info.filename))
+            if member_is_current(info, outfile, verify_crc):
+                continue
+#            print("extracting %s" % info.filename)
+            extract_member(input_zip, info, outfile)
     input_zip.close()
-    return tiff,xml
+    return extracted
+
+def extract_worker(args):
+    return extract_tiff_xml(*args)
+
+def extract_all(zip_list,swaths,pols=None,nproc=1,verify_crc=False,aoi=None,burst_ids=None):
+    '''Extract the TIFF and XML from each ZIP, using a pool of nproc processes'''
+    return run_pool(extract_worker,[(z,swaths,pols,verify_crc,aoi,burst_ids) for z in zip_list],nproc)
 
 ####################################################
-def get_orbit(meta_dict):
-    """ Find an orbit file for the scene
-    Use Precise (POE) orbit if available (i.e. scene is > 20 days old) otherwise use Restituted (RES)
+def burst_footprints(meta_dict):
+    '''Return the lon/lat bounding box (west, east, south, north) of each burst
 
-    """
-    if (datetime.datetime.now()-meta_dict['startTime']).days > 20:
-        orb_dir = 'aux_poeorb'
-    else:
-        orb_dir = 'aux_resorb'
-    ### using a local copy of all the orbit files, ideally something like ISCE uses to
-    ### search and download the orbits from either UNAVCO or PGDG would be ideal
-    ##### FIND THE CORRECT ORBIT FILE #####
-    BASE_URL = 'https://www.unavco.org/data/imaging/sar/lts1/winsar/s1qc'
-    ##### GET LIST OF FILES AND FIND ONE THAT COVERS THE SCENE #####
-    orb_file=None
-    files = urllib2.urlopen(BASE_URL+'/'+ orb_dir +'/').read().splitlines()
-    xml_resorb = [f.split(">")[2].split("<")[0] for f in files  if "ORB_" in f]
-    for xml_orb in xml_resorb:
-        orb_file_dates = os.path.splitext(xml_orb)[0].split('_V')[1].split("_")
-        orb_start = datetime.datetime.strptime(orb_file_dates[0], "%Y%m%dT%H%M%S")
-        orb_stop = datetime.datetime.strptime(orb_file_dates[1], "%Y%m%dT%H%M%S")
-        if (orb_start < meta_dict['startTime']) and (orb_stop > meta_dict['stopTime']):
-            orbit_file_url = BASE_URL+'/'+ orb_dir +'/'+xml_orb.strip()
-            orbit_file = os.path.basename(orbit_file_url)
-            if os.path.exists(orbit_file):
-                print("Orbit already downloaded: %s" % orbit_file)
+    meta_dict is parsed with bursts=True and geolocation=True.  Burst i covers
+    lines i*lines to (i+1)*lines of the subswath and its footprint is taken
+    from the geolocation grid points on those lines.
+    '''
+    grid = meta_dict['geolocation']
+    footprints = []
+    for i in range(len(meta_dict['burst_azimuthTime'])):
+        on_burst = (grid['line'] >= i*meta_dict['lines']) & (grid['line'] <= (i+1)*meta_dict['lines'])
+        lon = grid['longitude'][on_burst]
+        lat = grid['latitude'][on_burst]
+        footprints.append((lon.min(),lon.max(),lat.min(),lat.max()))
+    return footprints
+
+def select_bursts(meta_dict,aoi=None,burst_ids=None):
+    '''Return the first and last burst (numbered from 1) covering the AOI and/or burst IDs'''
+    selected = set(burst_ids or [])
+    if aoi is not None:
+        west, east, south, north = aoi
+        for i, (w,e,s,n) in enumerate(burst_footprints(meta_dict)):
+            if w <= east and e >= west and s <= north and n >= south:
+                selected.add(i+1)
+    num_bursts = len(meta_dict['burst_azimuthTime'])
+    selected = [b for b in selected if 1 <= b <= num_bursts]
+    if not selected:
+        return None
+    return min(selected), max(selected)
+
+def copy_bytes(source, target, size):
+    '''Copy size bytes from source to target, or skip them if target is None'''
+    while size > 0:
+        buf = source.read(min(size, COPY_BUFSIZE))
+        if not buf:
+            break
+        if target is not None:
+            target.write(buf)
+        size -= len(buf)
+
+def extract_member_bursts(input_zip, info, outfile, skip):
+    '''Copy a ZIP member to outfile, leaving the (start, stop) byte ranges in skip as holes
+
+    The file has the size of the member, but the skipped ranges are never
+    written so they take no disk space (a sparse file) and read as zeros.
+    '''
+    source = input_zip.open(info)
+    target = open(outfile,'wb')
+    pos = 0
+    for start, stop in sorted(skip):
+        copy_bytes(source, target, start-pos)
+        copy_bytes(source, None, stop-start)
+        target.seek(stop-start, 1)
+        pos = stop
+    copy_bytes(source, target, info.file_size-pos)
+    target.truncate(info.file_size)
+    target.close()
+    source.close()
+
+def extract_bursts(infile,input_zip,tiff_info,xml_info,slc_dir,aoi=None,burst_ids=None):
+    '''Extract only the bursts of a subswath covering the AOI and/or burst IDs
+
+    The bursts are chosen from the annotation read straight from the ZIP.
+    Only the selected bursts of the TIFF are written (see
+    extract_member_bursts) to a temporary directory, and the line range of
+    the bursts goes to GMTSAR assemble_tops, which writes <stem>-b<first>-<last>
+    .tiff and .xml with the burst list, timing and geolocation grid adjusted
+    to the cropped lines.  Returns [tiff, xml] of the crop, or None if every
+    burst (or no burst) is selected and the whole subswath is extracted.
+    '''
+    source = input_zip.open(xml_info)
+    meta_dict = parse_subswath_xml(source,bursts=True,geolocation=aoi is not None)
+    source.close()
+    first_last = select_bursts(meta_dict,aoi,burst_ids)
+    num_bursts = len(meta_dict['burst_azimuthTime'])
+    if first_last is None:
+        print("%s: no burst covers the AOI, keeping the whole subswath" % xml_info.filename)
+        return None
+    first, last = first_last
+    if first == 1 and last == num_bursts:
+        return None
+    stem = os.path.splitext(os.path.basename(tiff_info.filename))[0]
+    out_stem = os.path.join(slc_dir,'%s-b%d-%d' % (stem,first,last))
+    cropped = [out_stem+'.tiff',out_stem+'.xml']
+    if all(os.path.exists(f) and os.path.getmtime(f) >= os.path.getmtime(infile) for f in cropped):
+        return cropped
+    azi_1 = (first-1)*meta_dict['lines']
+    azi_2 = last*meta_dict['lines']-1
+    print("%s: bursts %d-%d (lines %d-%d)" % (stem,first,last,azi_1,azi_2))
+    burst_size = meta_dict['lines']*meta_dict['samples']*4 # complex int16 samples
+    skip = [(offset,offset+burst_size) for i,offset in enumerate(meta_dict['burst_byteOffset']) if not first <= i+1 <= last]
+    tmp_dir = out_stem+'.part'
+    if not os.path.exists(tmp_dir):
+        os.mkdir(tmp_dir)
+    try:
+        extract_member(input_zip, xml_info, os.path.join(tmp_dir,stem+'.xml'))
+        extract_member_bursts(input_zip, tiff_info, os.path.join(tmp_dir,stem+'.tiff'), skip)
+        gmtsarutils.run_command('assemble_tops %d %d %s %s' % (azi_1,azi_2,os.path.join(tmp_dir,stem),out_stem))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return cropped
+
+####################################################
+ORBIT_URL = 'https://www.unavco.org/data/imaging/sar/lts1/winsar/s1qc'
+ORBIT_DIRS = ['aux_poeorb','aux_resorb']
+ORBIT_TIME_FMT = "%Y%m%dT%H%M%S"
+MAX_ORBIT_SPAN = datetime.timedelta(days=8)
+
+def parse_orbit_name(orbit_file):
+    '''Return mission, orbit type, validity start and stop from an EOF file name
+
+    e.g. S1A_OPER_AUX_POEORB_OPOD_20160609T121746_V20160519T225943_20160521T005943.EOF
+    '''
+    c = os.path.splitext(os.path.basename(orbit_file))[0].split('_')
+    orb_start = datetime.datetime.strptime(c[6][1:], ORBIT_TIME_FMT)
+    orb_stop = datetime.datetime.strptime(c[7], ORBIT_TIME_FMT)
+    return c[0], c[3], orb_start, orb_stop
+
+class OrbitCatalog(object):
+    '''Local catalog of Sentinel-1 orbit files
+
+    The catalog directory holds the EOF files (a local mirror can keep them in
+    aux_poeorb/ and aux_resorb/ subdirectories) and orbit_index.txt, a list of
+    every known orbit sorted by start of validity.  Entries are either a file
+    in the catalog or the URL of an orbit that is downloaded the first time it
+    is needed.  Lookups are a binary search on the validity start.  The remote
+    listings are only read by refresh(remote=True), so the catalog otherwise
+    works offline.  The local EOF files are scanned again whenever the
+    catalog directory or one of its subdirectories changed after the index.
+    '''
+    index_name = 'orbit_index.txt'
+
+    def __init__(self, orbit_dir):
+        self.orbit_dir = os.path.abspath(orbit_dir)
+        self.index_file = os.path.join(self.orbit_dir, self.index_name)
+        self.entries = []
+        self.starts = []
+        if not os.path.exists(self.orbit_dir):
+            os.makedirs(self.orbit_dir)
+        if os.path.exists(self.index_file):
+            self.load()
+            if self.local_changed():
+                self.refresh(remote=False)
+        else:
+            self.refresh(remote=False)
+
+    def local_dirs(self):
+        return [self.orbit_dir] + [d for d in glob.glob(os.path.join(self.orbit_dir, '*')) if os.path.isdir(d)]
+
+    def local_changed(self):
+        '''Check whether EOF files were added to or removed from the catalog since the index was saved'''
+        index_time = os.path.getmtime(self.index_file)
+        return any(os.path.getmtime(d) > index_time for d in self.local_dirs())
+
+    def set_entries(self, entries):
+        self.entries = sorted(set(entries))
+        self.starts = [e[0] for e in self.entries]
+
+    def load(self):
+        entries = []
+        for line in open(self.index_file):
+            c = line.split()
+            if len(c) < 5:
                 continue
-            print("Downloading %s" % orbit_file_url)
-            s = urllib2.urlopen(orbit_file_url)
-            contents = s.read()
-            xmlfile = open(orbit_file, 'w')
+            entries.append((datetime.datetime.strptime(c[0], ORBIT_TIME_FMT),
+                            datetime.datetime.strptime(c[1], ORBIT_TIME_FMT), c[2], c[3], c[4]))
+        self.set_entries(entries)
+
+    def save(self):
+        tmp_file = self.index_file + '.tmp'
+        f = open(tmp_file, 'w')
+        for orb_start, orb_stop, mission, orb_type, location in self.entries:
+            f.write('%s %s %s %s %s\n' % (orb_start.strftime(ORBIT_TIME_FMT), orb_stop.strftime(ORBIT_TIME_FMT),
+                                          mission, orb_type, location))
+        f.close()
+        os.rename(tmp_file, self.index_file)
+        os.utime(self.index_file, None) # newer than the directory the rename changed
+
+    def refresh(self, remote=True):
+        '''Rebuild the index from the EOF files in the catalog and, if remote, the server listings
+
+        The remote orbits already in the index are kept, so a local rescan or
+        an unreachable server never loses them.
+        '''
+        found = dict((os.path.basename(e[4]), e[4]) for e in self.entries if e[4].startswith('http'))
+        for d in self.local_dirs():
+            for eof in glob.glob(os.path.join(d, '*.EOF')):
+                found[os.path.basename(eof)] = os.path.relpath(eof, self.orbit_dir)
+        if remote:
+            for orb_dir in ORBIT_DIRS:
+                url = ORBIT_URL + '/' + orb_dir + '/'
+                print("Reading orbit list %s" % url)
+                try:
+                    files = urllib2.urlopen(url).read().splitlines()
+                except urllib2.URLError as e:
+                    print("Could not read %s (%s), keeping the orbits already in the catalog" % (url, e))
+                    continue
+                for f in files:
+                    if "ORB_" not in f:
+                        continue
+                    name = f.split(">")[2].split("<")[0].strip()
+                    found.setdefault(name, url + name)
+        entries = []
+        for name, location in found.items():
+            try:
+                mission, orb_type, orb_start, orb_stop = parse_orbit_name(name)
+            except (IndexError, ValueError):
+                continue # not an orbit file name
+            entries.append((orb_start, orb_stop, mission, orb_type, location))
+        self.set_entries(entries)
+        self.save()
+        print("Orbit catalog %s: %d orbits" % (self.orbit_dir, len(self.entries)))
+
+    def find(self, mission, start, stop):
+        '''Return the entry covering start to stop, preferring POE to RES and then the latest start'''
+        best = None
+        i = bisect.bisect_left(self.starts, start)
+        while i > 0:
+            i -= 1
+            entry = self.entries[i]
+            if entry[0] < start - MAX_ORBIT_SPAN:
+                break
+            if entry[2] != mission or entry[1] <= stop:
+                continue
+            if best is None or (entry[3] == 'POEORB') > (best[3] == 'POEORB'):
+                best = entry
+        return best
+
+    def fetch(self, entry):
+        '''Return the local path of the orbit in entry, downloading it if needed'''
+        location = entry[4]
+        if not location.startswith('http'):
+            return os.path.join(self.orbit_dir, location)
+        orbit_file = os.path.join(self.orbit_dir, os.path.basename(location))
+        if not os.path.exists(orbit_file):
+            print("Downloading %s" % location)
+            contents = urllib2.urlopen(location).read()
+            xmlfile = open(orbit_file + '.part', 'w')
             xmlfile.write(contents)
             xmlfile.close()
-    return orbit_file
+            os.rename(orbit_file + '.part', orbit_file)
+        return orbit_file
+
+    def find_orbits(self, meta_list):
+        '''Return the local orbit file for each scene in meta_list (None if no orbit covers it)'''
+        orbit_files = []
+        downloaded = False
+        for meta_dict in meta_list:
+            entry = self.find(meta_dict['missionId'], meta_dict['startTime'], meta_dict['stopTime'])
+            if entry is None:
+                print("No orbit in %s covers %s %s, try refreshing the catalog" % (self.orbit_dir, meta_dict['missionId'], meta_dict['startTime']))
+                orbit_files.append(None)
+                continue
+            try:
+                orbit_file = self.fetch(entry)
+            except urllib2.URLError as e:
+                print("Could not download %s (%s)" % (entry[4], e))
+                orbit_files.append(None)
+                continue
+            if entry[4].startswith('http'):
+                self.entries[self.entries.index(entry)] = entry[:4] + (os.path.basename(orbit_file),)
+                downloaded = True
+            orbit_files.append(orbit_file)
+        if downloaded:
+            self.save()
+        return orbit_files
+
+####################################################
+def link_orbit(orbit_file, directory='.'):
+    '''Symlink an orbit file into directory and return its name'''
+    name = os.path.basename(orbit_file)
+    link = os.path.join(directory, name)
+    if not os.path.lexists(link):
+        os.symlink(os.path.abspath(orbit_file), link)
+    return name
 
 ####################################################
-def parse_subswath_xml(xmlfile):
+### PATHS (AS TAG SUFFIXES) OF THE ANNOTATION FIELDS NEEDED FOR THE PRM ###
+SUBSWATH_FIELDS = {
+    'missionId': ('adsHeader','missionId'),
+    'productType': ('adsHeader','productType'),
+    'polarisation': ('adsHeader','polarisation'),
+    'mode': ('adsHeader','mode'),
+    'swath': ('adsHeader','swath'),
+    'startTime': ('adsHeader','startTime'),
+    'stopTime': ('adsHeader','stopTime'),
+    'absoluteOrbitNumber': ('adsHeader','absoluteOrbitNumber'),
+    'flight_direction': ('generalAnnotation','productInformation','pass'),
+    'frequency': ('generalAnnotation','productInformation','radarFrequency'),
+    'rangeSampleRate': ('generalAnnotation','productInformation','rangeSamplingRate'),
+    'azimuthPixelSize': ('imageAnnotation','imageInformation','azimuthPixelSpacing'),
+    'azimuthTimeInterval': ('imageAnnotation','imageInformation','azimuthTimeInterval'),
+    'lines': ('swathTiming','linesPerBurst'),
+    'samples': ('swathTiming','samplesPerBurst'),
+    'slantRangeTime': ('imageAnnotation','imageInformation','slantRangeTime'),
+    'incidenceAngle': ('imageAnnotation','imageInformation','incidenceAngleMidSwath'),
+    'prf': ('generalAnnotation','downlinkInformationList','downlinkInformation','prf'),
+    'terrainHeight': ('generalAnnotation','terrainHeightList','terrainHeight','value'),
+}
+BURST_FIELDS = ('azimuthTime','azimuthAnxTime','sensingTime','byteOffset')
+GEOLOCATION_FIELDS = ('azimuthTime','slantRangeTime','line','pixel','latitude','longitude','height','incidenceAngle','elevationAngle')
+
+def parse_subswath_xml(xmlfile,bursts=False,geolocation=False):
     '''Parse S1 subswath xml file and assign metadata parameters
 
     This function will parse the xml file and assign the values needed
-    to a python dictionary
+    to a python dictionary.  The file (a name or an open file) is read in one
+    streaming pass with iterparse, elements are discarded as soon as they are
+    read, and reading stops once all the fields are found.  With bursts or
+    geolocation the burst timing (burst_<field>) and the geolocation grid
+    (geolocation, a dict of <field>: array) are added as NumPy arrays.
     '''
-    xmldoc = ET.parse(xmlfile).getroot()
+    by_tag = {}
+    for key, path in SUBSWATH_FIELDS.items():
+        by_tag.setdefault(path[-1], []).append((key, path))
+    text = {}
+    burst_list = dict((f, []) for f in BURST_FIELDS)
+    grid_list = dict((f, []) for f in GEOLOCATION_FIELDS)
+    path = []
+    for event, elem in ET.iterparse(xmlfile, events=('start','end')):
+        if event == 'start':
+            path.append(elem.tag)
+            continue
+        tag = path.pop()
+        parent = path[-1] if path else None
+        for key, field_path in by_tag.get(tag, []):
+            if key not in text and tuple(path[-len(field_path)+1:]) + (tag,) == field_path:
+                text[key] = elem.text
+        if bursts and parent == 'burst' and tag in burst_list:
+            burst_list[tag].append(elem.text)
+        if geolocation and parent == 'geolocationGridPoint' and tag in grid_list:
+            grid_list[tag].append(elem.text)
+        elem.clear()
+        if len(text) == len(SUBSWATH_FIELDS) and not bursts and not geolocation:
+            break
+    missing = sorted(set(SUBSWATH_FIELDS) - set(text))
+    if missing:
+        raise ValueError("%s is missing %s" % (getattr(xmlfile, 'name', xmlfile), ', '.join(missing)))
     meta_dict = {}
-    meta_dict['missionId'] = xmldoc.find('.//adsHeader/missionId').text
-    meta_dict['productType'] = xmldoc.find('.//adsHeader/productType').text
-    meta_dict['polarisation'] = xmldoc.find('.//adsHeader/polarisation').text
-    meta_dict['mode'] = xmldoc.find('.//adsHeader/mode').text
-    meta_dict['swath'] = xmldoc.find('.//adsHeader/swath').text
-    meta_dict['startTime'] =  datetime.datetime.strptime(xmldoc.find('.//adsHeader/startTime').text,"%Y-%m-%dT%H:%M:%S.%f")
-    meta_dict['stopTime'] =  datetime.datetime.strptime(xmldoc.find('.//adsHeader/stopTime').text,"%Y-%m-%dT%H:%M:%S.%f")
-    meta_dict['absoluteOrbitNumber'] = xmldoc.find('.//adsHeader/absoluteOrbitNumber').text
+    for key in ('missionId','productType','polarisation','mode','swath','absoluteOrbitNumber','flight_direction'):
+        meta_dict[key] = text[key]
+    meta_dict['startTime'] =  datetime.datetime.strptime(text['startTime'],"%Y-%m-%dT%H:%M:%S.%f")
+    meta_dict['stopTime'] =  datetime.datetime.strptime(text['stopTime'],"%Y-%m-%dT%H:%M:%S.%f")
 #    meta_dict['missionDataTakeId'] = xmldoc.find('.//adsHeader/missionDataTakeId').text
-    meta_dict['flight_direction'] = xmldoc.find('.//generalAnnotation/productInformation/pass').text
-    meta_dict['frequency'] = float(xmldoc.find('.//generalAnnotation/productInformation/radarFrequency').text)
-    meta_dict['rangeSampleRate'] = float(xmldoc.find('.//generalAnnotation/productInformation/rangeSamplingRate').text)
+    meta_dict['frequency'] = float(text['frequency'])
+    meta_dict['rangeSampleRate'] = float(text['rangeSampleRate'])
     meta_dict['rangePixelSize'] = 299792458./(2.0*meta_dict['rangeSampleRate'])
-    meta_dict['azimuthPixelSize'] = float(xmldoc.find('.//imageAnnotation/imageInformation/azimuthPixelSpacing').text)
-    meta_dict['azimuthTimeInterval'] = float(xmldoc.find('.//imageAnnotation/imageInformation/azimuthTimeInterval').text)
-    meta_dict['lines'] = int(xmldoc.find('.//swathTiming/linesPerBurst').text)
-    meta_dict['samples'] = int(xmldoc.find('.//swathTiming/samplesPerBurst').text)
-    meta_dict['startingRange'] = float(xmldoc.find('.//imageAnnotation/imageInformation/slantRangeTime').text)*299792458./2.0
-    meta_dict['incidenceAngle'] = float(xmldoc.find('.//imageAnnotation/imageInformation/incidenceAngleMidSwath').text)
-    meta_dict['prf'] = float(xmldoc.find('.//generalAnnotation/downlinkInformationList/downlinkInformation/prf').text)
-    meta_dict['terrainHeight'] = float(xmldoc.find('.//generalAnnotation/terrainHeightList/terrainHeight/value').text)
+    meta_dict['azimuthPixelSize'] = float(text['azimuthPixelSize'])
+    meta_dict['azimuthTimeInterval'] = float(text['azimuthTimeInterval'])
+    meta_dict['lines'] = int(text['lines'])
+    meta_dict['samples'] = int(text['samples'])
+    meta_dict['startingRange'] = float(text['slantRangeTime'])*299792458./2.0
+    meta_dict['incidenceAngle'] = float(text['incidenceAngle'])
+    meta_dict['prf'] = float(text['prf'])
+    meta_dict['terrainHeight'] = float(text['terrainHeight'])
+    if bursts:
+        meta_dict['burst_azimuthTime'] = np.array(burst_list['azimuthTime'], dtype='datetime64[us]')
+        meta_dict['burst_sensingTime'] = np.array(burst_list['sensingTime'], dtype='datetime64[us]')
+        meta_dict['burst_azimuthAnxTime'] = np.array(burst_list['azimuthAnxTime'], dtype=float)
+        meta_dict['burst_byteOffset'] = np.array(burst_list['byteOffset'], dtype=np.int64)
+    if geolocation:
+        grid = {}
+        grid['azimuthTime'] = np.array(grid_list['azimuthTime'], dtype='datetime64[us]')
+        for f in GEOLOCATION_FIELDS[1:]:
+            grid[f] = np.array(grid_list[f], dtype=float)
+        meta_dict['geolocation'] = grid
     return meta_dict
 
 ####################################################
-def calc_dop_orb(prm_file):
-    ##### COMPUTE DOPPLER AND UPDATE PRM FILE #####
-    log_file = os.path.splitext(prm_file)[0] + '.log'
-    output = gmtsarutils.run_command('calc_dop_orb ' + prm_file + ' ' + log_file + ' 0 0')
-    log_out = open(log_file).readlines()
-    PRM = open(prm_file, 'a')
-    for line in log_out:
-        PRM.write(line)
-    PRM.close()
-    os.remove(log_file)
+RELATIVE_ORBIT_OFFSET = {'S1A': 73, 'S1B': 27}
+
+def scan_zip(infile):
+    '''Read the metadata of every subswath annotation in a SAFE ZIP without extracting anything
+
+    The annotation XML is parsed straight from the ZIP member stream.
+    Returns a list with one dict per annotation.
+    '''
+    input_zip = zipfile.ZipFile(infile)
+    inventory = []
+    for info in input_zip.infolist():
+        m = SLC_MEMBER_RE.match(info.filename)
+        if not m or m.group(1) != 'annotation':
+            continue
+        source = input_zip.open(info)
+        meta_dict = parse_subswath_xml(source,bursts=True)
+        source.close()
+        meta_dict['zip'] = infile
+        meta_dict['xml'] = os.path.basename(info.filename)
+        meta_dict['bursts'] = len(meta_dict['burst_azimuthTime'])
+        offset = RELATIVE_ORBIT_OFFSET.get(meta_dict['missionId'])
+        if offset is not None:
+            meta_dict['relativeOrbitNumber'] = (int(meta_dict['absoluteOrbitNumber']) - offset) % 175 + 1
+        inventory.append(meta_dict)
+    input_zip.close()
+    return inventory
+
+def scan_stack(zip_list,nproc=1):
+    '''Metadata-only inventory of a list of SAFE ZIPs, scanned in parallel'''
+    inventory = []
+    for zip_inventory in run_pool(scan_zip,zip_list,nproc):
+        inventory.extend(zip_inventory)
+    return sorted(inventory, key=lambda m: (m['startTime'],m['swath'],m['polarisation']))
+
+def print_inventory(inventory):
+    print("%-10s %-4s %-5s %-3s %6s %4s %6s  %s" % ('date','sat','swath','pol','orbit','rel','bursts','zip'))
+    for m in inventory:
+        print("%-10s %-4s %-5s %-3s %6s %4s %6d  %s" % (m['startTime'].strftime('%Y%m%d'),m['missionId'],m['swath'],
+              m['polarisation'],m['absoluteOrbitNumber'],m.get('relativeOrbitNumber',''),m['bursts'],os.path.basename(m['zip'])))
+
+####################################################
+def make_slc(meta_dict):
+    '''Run make_s1a_tops, ext_orb_s1a and calc_dop_orb for one swath of an acquisition
+
+    The commands run in the swath's SLC subdirectory (slc_dir).  Returns None,
+    or the error message if anything failed so the other swaths carry on.
+    '''
+    prefix = meta_dict['prefix']
+    print("Working on %s/%s" % (meta_dict['slc_dir'],prefix))
+    cwd = os.getcwd()
+    os.chdir(meta_dict['slc_dir'])
+    try:
+        with stagetrace.Stage('make_slc', scene=prefix, slc_dir=meta_dict['slc_dir']):
+            gmtsarutils.cached_command('make_s1a_tops %s %s %s 0' % (meta_dict['xml'],meta_dict['tiff'],prefix),
+                                       [meta_dict['xml'],meta_dict['tiff']], [prefix+'.PRM',prefix+'.LED'],
+                                       checked=[prefix+'.SLC'])
+            gmtsarutils.cached_command('ext_orb_s1a %s %s %s' % (meta_dict['prm'],meta_dict['orbit_file'],prefix),
+                                       [meta_dict['prm'],meta_dict['orbit_file']], [prefix+'.PRM',prefix+'.LED'])
+            gmtsarutils.calc_dop_orb(meta_dict['prm'])
+    except Exception as e:
+        print("FAILED %s/%s: %s" % (meta_dict['slc_dir'],prefix,e))
+        return '%s: %s' % (type(e).__name__,e)
+    finally:
+        os.chdir(cwd)
+    return None
 
 ####################################################
-def compute_baselines(masterDate):
+def compute_baselines(masterDate,index=None,native=False,nproc=1):
     masterPRM = glob.glob("*"+masterDate+'*.PRM')[0]
-    prmDict = gmtsarutils.read_prm(masterPRM)
-    prmList = sorted(glob.glob('*PRM'))
+    prmList = sorted(gmtsarutils.load_prm_dir('.', '*PRM'))
+    if not native:
+        outDicts = gmtsarutils.sat_baselines(masterPRM, prmList, nproc)
+        bperp = [float(d['B_perpendicular']) for d in outDicts]
+        bpar = [float(d['B_parallel']) for d in outDicts]
+    elif index is None:
+        bperp, bpar = gmtsarutils.orbit_baselines(masterPRM, prmList)
+    else:
+        bperp, bpar = index.baselines(masterPRM, prmList)
+    dates = [gmtsarutils.prm_date(scene) for scene in prmList]
+    slcs = [os.path.splitext(scene)[0]+'.SLC' for scene in prmList]
     f = open('bl_list.txt','w')
-    dates = []
-    pbase = []
-    for scene in prmList:
-        temp_dict = gmtsarutils.read_prm(scene)
-        date = os.path.splitext(scene)[0].split("_")[1]
-        cmd = 'SAT_baseline ' + masterPRM + ' ' + scene
-        print(cmd)
-        output = gmtsarutils.run_command(cmd) 
-        tmp = output.split('\n')
-        outDict = {}
-        for l in tmp:
-            c = l.split("=")
-            if len(c) < 2:
-                next
-            else:
-                outDict[c[0].strip()] = str.replace(c[1], '\n', '').strip()
-        dates.append(date)
-        pbase.append(float(outDict['B_perpendicular']))
-        f.write('%s %5.6f %5.6f %s\n' % (date,float(outDict['B_perpendicular']),float(outDict['B_parallel']),os.path.splitext(scene)[0]+'.SLC'))
+    for date,bp,bl,slc in zip(dates,bperp,bpar,slcs):
+        f.write('%s %5.6f %5.6f %s\n' % (date,bp,bl,slc))
     f.close()
-    ### FIND MASTER DATE THAT MINIMIZES BASELINE ###
-    dates = np.array(dates)
-    pbase = np.array(pbase)
-    optimal_ref = dates.flat[np.abs(pbase - np.mean(pbase)).argmin()]
+    if index is not None:
+        index.write_baseline_list(os.path.basename(os.getcwd()),dates,bperp,bpar,slcs)
+    ### RANK THE REFERENCE CANDIDATES BY TOTAL NETWORK BASELINE ###
+    dates, bperp, bpar, tbase = gmtsarutils.baseline_matrix('bl_list.txt')
+    order, score = gmtsarutils.rank_references(bperp, tbase)
+    optimal_ref = dates[order[0]]
     print("OPTIMAL REFERENCE DATE: %s" % optimal_ref)
     return optimal_ref
 
+####################################################
+def acquisition_span(meta_list):
+    '''Mission and time span covering every swath of one acquisition'''
+    return {'missionId': meta_list[0]['missionId'],
+            'startTime': min(m['startTime'] for m in meta_list),
+            'stopTime': max(m['stopTime'] for m in meta_list)}
+
+def plan_acquisitions(zip_list,extracted,index,catalog):
+    '''Group the extracted swaths by acquisition (ZIP) and resolve the orbit once per acquisition
+
+    extracted is the output of extract_all.  Returns a list of acquisition
+    dicts with the zip, orbit_file (None if no orbit covers it) and scenes,
+    one parse_subswath_xml dict per swath with slc_dir, tiff, xml, prefix,
+    prm and orbit_file added.  The orbit is linked into each swath directory.
+    '''
+    files = [(i,slc_dir,t,x) for i,e in enumerate(extracted) for slc_dir,(t,x) in sorted(e.items()) if t and x]
+    acquisitions = [{'zip': z, 'scenes': []} for z in zip_list]
+    with stagetrace.Stage('parse_xml'):
+        for i,slc_dir,tiff,xml in files:
+            meta_dict = index.parse_xml(xml,parse_subswath_xml)
+            meta_dict['slc_dir'] = slc_dir
+            meta_dict['tiff'] = os.path.basename(tiff)
+            meta_dict['xml'] = os.path.basename(xml)
+            meta_dict['prefix'] = meta_dict['swath']+'_'+meta_dict['startTime'].strftime('%Y%m%d')
+            meta_dict['prm'] = meta_dict['prefix']+'.PRM'
+            acquisitions[i]['scenes'].append(meta_dict)
+    acquisitions = [a for a in acquisitions if a['scenes']]
+    with stagetrace.Stage('orbit', acquisitions=len(acquisitions)):
+        spans = [acquisition_span(a['scenes']) for a in acquisitions]
+        for acquisition,span,orbit_file in zip(acquisitions,spans,catalog.find_orbits(spans)):
+            acquisition.update(span)
+            acquisition['orbit_file'] = orbit_file
+            if orbit_file is None:
+                print("Skipping %s" % acquisition['zip'])
+                continue
+            for meta_dict in acquisition['scenes']:
+                meta_dict['orbit_file'] = link_orbit(orbit_file,meta_dict['slc_dir'])
+    return acquisitions
+
+def write_manifest(acquisition,manifest_dir='manifests'):
+    '''Write the orbit, files and status of each swath of an acquisition to <manifest_dir>/<SAFE name>.json'''
+    if not os.path.exists(manifest_dir):
+        os.mkdir(manifest_dir)
+    scenes = []
+    for meta_dict in acquisition['scenes']:
+        if acquisition['orbit_file'] is None:
+            status = 'no orbit'
+        else:
+            status = 'failed' if meta_dict.get('error') else 'done'
+        scene = {'slc_dir': meta_dict['slc_dir'], 'swath': meta_dict['swath'], 'polarisation': meta_dict['polarisation'],
+                 'tiff': meta_dict['tiff'], 'xml': meta_dict['xml'], 'prm': meta_dict['prm'],
+                 'slc': meta_dict['prefix']+'.SLC', 'led': meta_dict['prefix']+'.LED', 'status': status}
+        if meta_dict.get('error'):
+            scene['error'] = meta_dict['error']
+        scenes.append(scene)
+    manifest = {'zip': acquisition['zip'], 'mission': acquisition['missionId'],
+                'startTime': acquisition['startTime'].strftime("%Y-%m-%dT%H:%M:%S.%f"),
+                'stopTime': acquisition['stopTime'].strftime("%Y-%m-%dT%H:%M:%S.%f"),
+                'absoluteOrbitNumber': acquisition['scenes'][0]['absoluteOrbitNumber'],
+                'orbit_file': acquisition['orbit_file'], 'scenes': scenes}
+    name = os.path.splitext(os.path.basename(acquisition['zip']))[0]
+    manifest_file = os.path.join(manifest_dir,name+'.json')
+    f = open(manifest_file,'w')
+    json.dump(manifest,f,indent=2,sort_keys=True)
+    f.close()
+    return manifest_file
+
+def finish_swath(scene_list,index,native=False,nproc=1):
+    '''Write data.in and bl_list.txt for the prepared scenes of one swath in the current directory'''
+    scene_list = sorted(scene_list,key=lambda m: m['startTime'])
+    datain_file = open("data.in",'w')
+    for tmp_meta in scene_list:
+        datain_file.write("%s:%s\n" %(os.path.splitext(tmp_meta['tiff'])[0],tmp_meta['orbit_file']))
+    datain_file.close()
+    with stagetrace.Stage('baselines', slc_dir=os.path.basename(os.getcwd())):
+        return compute_baselines(scene_list[-1]['startTime'].strftime('%Y%m%d'),index,native,nproc)
+
 ####################################################
 def parse():
     '''Command line parser.'''
     parser = argparse.ArgumentParser(description='Align a stack of Sentinel-1 scenes')
-    parser.add_argument('-s', action='store', type=str, dest='swath_num', required=True, help='Swath number (integer, without IW or EW)')
+    parser.add_argument('-s', action='store', type=str, nargs='+', dest='swaths', choices=['1','2','3'], help='Swath numbers (integers, without IW or EW), e.g. -s 1 2 3')
+    parser.add_argument('-p', action='store', type=str, nargs='+', dest='pols', choices=['vv','vh','hh','hv'], help='Polarisations (Default: the co-polarisation VV or HH)')
+    parser.add_argument('-scan', action='store_true', default=False, help='Only list the dates, swaths, polarisations, orbits and bursts in raw/ without extracting anything')
+    parser.add_argument('-n', action='store', type=int, dest='nproc', default=1, help='Number of processes for extracting and preparing the scenes (Default: 1)')
+    parser.add_argument('-orbdir', action='store', type=str, dest='orbit_dir', default=os.environ.get('S1_ORBIT_DIR', os.path.join(os.getcwd(),'orbits')), help='Orbit catalog directory (Default: $S1_ORBIT_DIR or ./orbits)')
+    parser.add_argument('-orbrefresh', action='store', type=str, nargs='?', const='remote', default=None, dest='orbit_refresh', choices=['remote','local'], help='Refresh the orbit catalog from the orbit server, or with "local" only rescan the EOF files in -orbdir')
+    parser.add_argument('-db', action='store', type=str, dest='db', default=os.path.join(os.getcwd(),stackindex.DB_NAME), help='Stack index database (Default: ./stack.db)')
+    parser.add_argument('-crc', action='store_true', default=False, dest='verify_crc', help='Check the CRC of already extracted files, not just their size')
+    parser.add_argument('-aoi', action='store', type=float, nargs=4, dest='aoi', metavar=('WEST','EAST','SOUTH','NORTH'), help='Only keep the bursts covering this lon/lat box')
+    parser.add_argument('-bursts', action='store', type=int, nargs='+', dest='burst_ids', help='Only keep these bursts (numbered from 1 in each subswath)')
+    parser.add_argument('-native', action='store_true', default=False, help='Compute the baselines natively instead of with SAT_baseline (not yet validated, see createBaselinesGMTSAR.py -check)')
+    parser.add_argument('-trace', action='store', type=str, dest='trace', help='Append the time and resources of each stage and command to this JSON lines file (see stagetrace.py)')
+    parser.add_argument('-cache', action='store', type=str, dest='cache', help='Cache the results of the GMTSAR commands in this directory and replay them on reruns (see resultcache.py)')
+    parser.add_argument('-cachesize', action='store', type=float, dest='cache_size', help='Size limit of the cache in MB (Default: 20000)')
 #    parser.add_argument('-ref', action='store', type=str, dest='ref_date', required=False, help='Reference (master) date to align SLCs')
     clos = parser.parse_args()
+    if not clos.scan and not clos.swaths:
+        parser.error('argument -s is required')
     return clos
 
 if __name__ == '__main__':
     clos = parse()
     if len(sys.argv)<2:
-        print("USAGE: tops_prepare_stack.py SUBSWATH\n  Example:\n  tops_prepare_stack.py 1\nThis command will extract the VV or HH IW1 subswath from each Sentinel-1 ZIP file in a raw directory to the SLC directory and create data.in")
+        print("USAGE: tops_prepare_stack.py -s SUBSWATH [SUBSWATH ...]\n  Example:\n  tops_prepare_stack.py -s 1 2 3\nThis command will extract the VV or HH subswaths from each Sentinel-1 ZIP file in a raw directory to SLC/IW1, SLC/IW2, ... and create data.in in each")
         exit()
     safe_zip_list = sorted(glob.glob(os.getcwd()+"/raw/S1*_IW_SLC*.zip"))
+    if clos.scan:
+        print_inventory(scan_stack(safe_zip_list,clos.nproc))
+        sys.exit()
     if not os.path.exists("SLC"):
         os.mkdir("SLC")
+    if clos.trace:
+        stagetrace.enable(clos.trace)
+    if clos.cache:
+        resultcache.enable(clos.cache,clos.cache_size)
+    index = stackindex.StackIndex(clos.db)
+    catalog = OrbitCatalog(clos.orbit_dir)
+    if clos.orbit_refresh:
+        catalog.refresh(remote=clos.orbit_refresh == 'remote')
     os.chdir("SLC")
-    datain_file = open("data.in",'w')
-    for z in safe_zip_list:
-        print("Working on %s" % z)
-        tmp_tiff,tmp_xml = extract_tiff_xml(z,clos.swath_num)
-        tmp_meta = parse_subswath_xml(tmp_xml)
-        tmp_orbit_file = get_orbit(tmp_meta)
-        tmp_meta['orbit_file'] = tmp_orbit_file
-        tmp_meta['tiff'] = tmp_tiff
-        tmp_meta['xml'] = tmp_xml
-        tmp_meta['prefix'] = tmp_meta['swath']+'_'+tmp_meta['startTime'].strftime('%Y%m%d')
-        tmp_meta['prm'] = tmp_meta['prefix']+'.PRM'
-        output = gmtsarutils.run_command('make_s1a_tops %s %s %s 0' % (tmp_meta['xml'],tmp_meta['tiff'],tmp_meta['prefix']) )
-        output = gmtsarutils.run_command('ext_orb_s1a %s %s %s' % (tmp_meta['prm'],tmp_meta['orbit_file'],tmp_meta['prefix']) )
-        calc_dop_orb(tmp_meta['prm'])
-        datain_file.write("%s:%s\n" %(os.path.splitext(tmp_tiff)[0],tmp_orbit_file))
-
-    ref_date = compute_baselines(tmp_meta['startTime'].strftime('%Y%m%d'))
+    by_pol = clos.pols is not None and len(clos.pols) > 1
+    for swath in clos.swaths:
+        for pol in (clos.pols if by_pol else [None]):
+            slc_dir = slc_dir_name('iw'+swath,pol or '',by_pol)
+            if not os.path.exists(slc_dir):
+                os.mkdir(slc_dir)
+    print("Extracting %d ZIP files" % len(safe_zip_list))
+    with stagetrace.Stage('extract', zips=len(safe_zip_list)):
+        extracted = extract_all(safe_zip_list,clos.swaths,clos.pols,clos.nproc,clos.verify_crc,clos.aoi,clos.burst_ids)
+    acquisitions = plan_acquisitions(safe_zip_list,extracted,index,catalog)
+    scene_list = [m for a in acquisitions if a['orbit_file'] for m in a['scenes']]
+    print("Preparing %d swaths of %d acquisitions" % (len(scene_list),len(acquisitions)))
+    with stagetrace.Stage('prepare', scenes=len(scene_list)):
+        errors = run_pool(make_slc,scene_list,clos.nproc)
+    for meta_dict,error in zip(scene_list,errors):
+        meta_dict['error'] = error
+    for acquisition in acquisitions:
+        write_manifest(acquisition)
+    for slc_dir in sorted(set(m['slc_dir'] for m in scene_list)):
+        done = [m for m in scene_list if m['slc_dir'] == slc_dir and not m['error']]
+        if not done:
+            continue
+        os.chdir(slc_dir)
+        finish_swath(done,index,clos.native,clos.nproc)
+        os.chdir('..')
+    failed = [m for m in scene_list if m['error']]
+    if failed:
+        print("%d swaths failed, see SLC/manifests" % len(failed))
+    index.close()